@@ -1,51 +1,61 @@
+import asyncio
 import json
+import logging
+from collections import namedtuple
+from datetime import timedelta
+import time
+import msgpack
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
-from .models import Message, Chat
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+from .models import Chat, Message, ChatUser
 from .serializers import MessageSerializer
-from tokens.utils import check_token
+from .utils import metrics
+from .utils.presence import get_presence
+from .utils.rate_limiter import TokenBucket
+from .utils.read_positions import ReadPositionBuffer
+from .utils.ttl_cache import TTLCache
+from .utils.write_behind import WriteBehindBuffer
+from tokens.utils import decode_token
 
 
-@database_sync_to_async
-def check_chat_id(chat_id):
-    return Chat.objects.filter(pk=chat_id).exists()
+logger = logging.getLogger(__name__)
 
 
-@database_sync_to_async
-def is_chat_member(user, chat_id):
-    chat = Chat.objects.get(pk=chat_id)
-    return chat.users.filter(pk=user.id).exists()
+def serialize_message(message):
+    serializer = MessageSerializer(instance=message)
+
+    return dict(serializer.data)
 
 
 @database_sync_to_async
-def is_message_owner(user, message_id):
-    return Message.objects.filter(pk=message_id, user=user.id).exists()
+def get_user_chat_ids(user):
+    return set(ChatUser.objects.filter(user=user).values_list('chat_id', flat=True))
 
 
-@database_sync_to_async
-def serialize_message(message):
-    serializer = MessageSerializer(instance=message)
+def get_user_group_name(user_id):
+    return f'user_{user_id}'
 
-    return dict(serializer.data)
 
+def get_activity_group_name(chat_id):
+    return f'activity_{chat_id}'
 
-@database_sync_to_async
-def get_user_chats(user):
-    return list(user.chats.all())
 
+def get_own_message(data, user):
+    message = Message.objects.select_related('user').filter(pk=data['message_id'], chat_id=data['chat_id']).first()
+    if not message:
+        return None, {'message': 'No message with this id found'}
 
-@database_sync_to_async
-def save_new_message(data, scope):
-    user = scope['user']
+    if message.user_id != user.id:
+        return None, {'message_id': 'You are trying to modify not your message'}
 
-    chat = Chat.objects.get(pk=data['chat_id'])
+    return message, None
 
-    message = Message.objects.create(
-        user=user,
-        chat=chat,
-        text=data['text']
-    )
 
+def add_message_relations(message, data):
     errors = {}
     file_ids = message.add_files(data['files']) if 'files' in data else None
     if file_ids:
@@ -54,75 +64,542 @@ def save_new_message(data, scope):
     if article_ids:
         errors['articles'] = f'Articles with the following ids not found: {", ".join(article_ids)}'
 
-    if len(errors) == 0:
-        errors = None
+    return errors if len(errors) else None
+
+
+SavedMessage = namedtuple('SavedMessage', ['response', 'errors', 'duplicate'])
+
+
+def get_client_side_id(data):
+    return str(data['client_side_id']) if data.get('client_side_id') is not None else None
+
+
+def get_dedupe_key(data, user):
+    client_side_id = get_client_side_id(data)
+
+    return (user.id, data['chat_id'], client_side_id) if client_side_id else None
+
+
+def get_dedupe_query(key):
+    user_id, chat_id, client_side_id = key
+
+    return Q(user_id=user_id, chat_id=chat_id, client_side_id=client_side_id)
+
+
+def is_client_side_id_conflict(error):
+    # PostgreSQL reports the name of the violated constraint, sqlite only its columns
+    diag = getattr(error.__cause__, 'diag', None)
+    if diag is not None:
+        return diag.constraint_name == 'unique_message_client_side_id'
 
-    return message, errors
+    return 'client_side_id' in str(error)
+
+
+def release_client_side_ids(query):
+    # ids are deduplicated only for CHAT_DEDUPE_TTL seconds, after that they may be reused by new messages
+    cutoff = timezone.now() - timedelta(seconds=settings.CHAT_DEDUPE_TTL)
+    Message.objects.filter(query, date__lt=cutoff).update(client_side_id=None)
+
+
+def create_message(data, user):
+    key = get_dedupe_key(data, user)
+    fields = {'user': user, 'chat_id': data['chat_id'], 'text': data.get('text', ''),
+              'client_side_id': key[2] if key else None}
+
+    try:
+        with transaction.atomic():
+            message = Message.objects.create(**fields)
+    except IntegrityError as error:
+        if not key or not is_client_side_id_conflict(error):
+            raise
+
+        release_client_side_ids(get_dedupe_query(key))
+        message = Message.objects.select_related('user').filter(get_dedupe_query(key)).first()
+        if message:
+            # the same send has already been stored, e.g. by another worker before a reconnect
+            return SavedMessage(serialize_message(message), None, True)
+
+        message = Message.objects.create(**fields)
+
+    errors = add_message_relations(message, data)
+
+    return SavedMessage(serialize_message(message), errors, False)
+
+
+def get_stored_messages(entries):
+    keys = {get_dedupe_key(data, user) for data, user in entries} - {None}
+    if not keys:
+        return {}
+
+    query = Q()
+    for key in keys:
+        query |= get_dedupe_query(key)
+
+    release_client_side_ids(query)
+
+    return {(message.user_id, message.chat_id, message.client_side_id): message
+            for message in Message.objects.select_related('user').filter(query)}
+
+
+def bulk_create_messages(entries):
+    stored_messages = get_stored_messages(entries)
+
+    messages, new_messages = [], []
+    for data, user in entries:
+        key = get_dedupe_key(data, user)
+        if key and key in stored_messages:
+            messages.append((stored_messages[key], True))
+            continue
+
+        message = Message(user=user, chat_id=data['chat_id'], text=data.get('text', ''),
+                          client_side_id=key[2] if key else None)
+        if key:
+            # a retry within the same batch maps to the first send
+            stored_messages[key] = message
+        messages.append((message, False))
+        new_messages.append(message)
+
+    if connection.features.can_return_rows_from_bulk_insert:
+        Message.objects.bulk_create(new_messages)
+    else:
+        # primary keys are needed to attach files, sqlite does not return them from bulk insert
+        for message in new_messages:
+            message.save()
+
+    results = []
+    for (message, duplicate), (data, _) in zip(messages, entries):
+        if duplicate:
+            results.append(SavedMessage(serialize_message(message), None, True))
+            continue
+
+        errors = add_message_relations(message, data)
+        results.append(SavedMessage(serialize_message(message), errors, False))
+
+    return results
+
+
+# every command below is a single unit of work: one thread hop and one transaction
+# covering validation, persistence and building of the broadcast payload
 
 
 @database_sync_to_async
-def update_message(data):
-    message = Message.objects.filter(pk=data['message_id']).first()
-    if not message:
-        return None, {'message': 'No message with this id found'}
+def save_new_message(data, user):
+    with transaction.atomic():
+        return create_message(data, user)
 
-    message.text = data['text']
 
-    errors = {}
-    file_errors = message.update_files(data['files']) if 'files' in data else None
-    if file_errors:
-        errors['files'] = file_errors
-    article_errors = message.update_articles(data['articles']) if 'articles' in data else None
-    if article_errors:
-        errors['articles'] = article_errors
+@database_sync_to_async
+def save_new_messages(entries):
+    """
+    write-behind counterpart of save_new_message: persists a batch of (data, user)
+    entries in one transaction and returns results in the same order
+    """
+    try:
+        with transaction.atomic():
+            return bulk_create_messages(entries)
+    except DatabaseError:
+        # e.g. another worker stored one of the client_side_ids meanwhile. Entries are saved one by one then,
+        # so a failing entry is returned as its exception and does not fail the others
+        results = []
+        for data, user in entries:
+            try:
+                with transaction.atomic():
+                    results.append(create_message(data, user))
+            except DatabaseError as error:
+                results.append(error)
+
+        return results
+
+
+message_buffer = WriteBehindBuffer(save_new_messages, settings.CHAT_WRITE_BEHIND_DELAY,
+                                   settings.CHAT_WRITE_BEHIND_MAX_SIZE)
+
+# recently sent messages by (user id, chat id, client_side_id), retried sends are answered from here without writes
+sent_messages = TTLCache(settings.CHAT_DEDUPE_CACHE_SIZE, settings.CHAT_DEDUPE_TTL)
 
-    if len(errors) == 0:
-        errors = None
+# rate limit buckets by (user id, message type) shared by all connections of the user in this process
+user_rate_limit_buckets = TTLCache(settings.CHAT_USER_RATE_LIMIT_CACHE_SIZE, settings.CHAT_USER_RATE_LIMIT_TTL)
 
-    message.save()
+# (chat id, user id) of users who were announced as typing within the current coalescing window
+typing_users = TTLCache(settings.CHAT_TYPING_CACHE_SIZE, settings.CHAT_TYPING_WINDOW)
 
-    return message, errors
+
+# furthest read positions by (chat id, user id) saved in this process, receipts which do not move them are dropped
+read_positions = TTLCache(settings.CHAT_READ_POSITIONS_CACHE_SIZE, settings.CHAT_READ_POSITIONS_TTL)
 
 
 @database_sync_to_async
-def delete_message(data):
-    message = Message.objects.filter(pk=data['message_id']).first()
-    if not message:
-        return {'message': 'No message with this id found'}
+def write_read_positions(positions):
+    """
+    positions are capped at the last message of their chats, every one is written in its own savepoint,
+    so a failing receipt does not roll back the rest of the batch. Returns the positions which were saved
+    """
+    last_message_ids = dict(Chat.objects.filter(id__in={chat_id for chat_id, _ in positions})
+                            .values_list('id', 'last_message_id'))
 
-    message.delete()
+    saved = {}
+    with transaction.atomic():
+        for (chat_id, user_id), message_id in positions.items():
+            if not last_message_ids.get(chat_id):
+                continue
 
+            message_id = min(message_id, last_message_ids[chat_id])
+            try:
+                with transaction.atomic():
+                    ChatUser.advance_last_read(chat_id, user_id, message_id)
+            except DatabaseError:
+                logger.exception('Failed to save read position %s of user %s in chat %s', message_id, user_id, chat_id)
+            else:
+                saved[(chat_id, user_id)] = message_id
 
-class ChatConsumer(AsyncWebsocketConsumer):
-    ALLOWED_MESSAGE_TYPES = ['new_message', 'update_message', 'delete_message']
+    return saved
 
-    async def connect(self):
-        user_chats = await get_user_chats(self.scope['user'])
-        for chat in user_chats:
-            await self.channel_layer.group_add(
-                str(chat.id),
-                self.channel_name,
-            )
 
-        await self.accept()
+async def save_read_positions(positions):
+    # only written positions are cached, so receipts after a failed flush are not dropped as stale
+    saved = await write_read_positions(positions)
+    for key, message_id in saved.items():
+        if message_id > read_positions.get(key, 0):
+            read_positions.set(key, message_id)
 
-    async def disconnect(self, close_code):
 
-        user_chats = await get_user_chats(self.scope['user'])
+read_position_buffer = ReadPositionBuffer(save_read_positions, settings.CHAT_READ_FLUSH_DELAY)
 
-        for chat in user_chats:
-            await self.channel_layer.group_discard(
-                str(chat.id),
-                self.channel_name,
-            )
 
-    async def success_message(self, event):
+@database_sync_to_async
+def get_missed_messages(positions, limit):
+    """
+    messages newer than the last seen ones across several chats, fetched with one query
+    """
+    query = Q()
+    for chat_id, message_id in positions.items():
+        query |= Q(chat_id=chat_id, id__gt=message_id)
+
+    messages = list(Message.objects.select_related('user').prefetch_related('files', 'articles')
+                    .filter(query).order_by('id')[:limit + 1])
+
+    return [serialize_message(message) for message in messages[:limit]], len(messages) > limit
+
+
+@database_sync_to_async
+def update_message(data, user):
+    with transaction.atomic():
+        message, errors = get_own_message(data, user)
+        if not message:
+            return None, errors
+
+        message.text = data.get('text', message.text)
+
+        errors = {}
+        file_errors = message.update_files(data['files']) if 'files' in data else None
+        if file_errors:
+            errors['files'] = file_errors
+        article_errors = message.update_articles(data['articles']) if 'articles' in data else None
+        if article_errors:
+            errors['articles'] = article_errors
+
+        if len(errors) == 0:
+            errors = None
+
+        message.save()
+
+        return serialize_message(message), errors
+
+
+@database_sync_to_async
+def delete_message(data, user):
+    with transaction.atomic():
+        message, errors = get_own_message(data, user)
+        if not message:
+            return None, errors
+
+        # clients keep the number of the deleted message, so its gap is not taken for a missed broadcast
+        seq = message.seq
+        message.delete()
+
+        return seq, None
+
+
+class ChatConsumer(AsyncWebsocketConsumer):
+    CHAT_MESSAGE_TYPES = ['new_message', 'update_message', 'delete_message', 'typing', 'read']
+    CONNECTION_MESSAGE_TYPES = ['refresh_token', 'subscribe', 'unsubscribe', 'sync', 'ping', 'pong']
+    ALLOWED_MESSAGE_TYPES = CHAT_MESSAGE_TYPES + CONNECTION_MESSAGE_TYPES
+
+    TOKEN_EXPIRED_CLOSE_CODE = 4001
+    IDLE_CLOSE_CODE = 4002
+    SLOW_CONSUMER_CLOSE_CODE = 4008
+
+    # upper bound of the integer columns which store message ids, e.g. ChatUser.last_read
+    MAX_MESSAGE_ID = 2 ** 31 - 1
+
+    # what to do when a slow client has CHAT_OUTBOUND_WINDOW unacknowledged frames
+    OVERFLOW_RESYNC = 'resync'
+    OVERFLOW_CLOSE = 'close'
+
+    # binary frames encoded with MessagePack, JSON text frames stay the default
+    MSGPACK_SUBPROTOCOL = 'ggaek.msgpack.v1'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.chat_ids = set()
+        # names of the joined groups, so disconnect does not need to query the database
+        self.chat_groups = set()
+        # in lazy subscription mode sockets get unread badges of all their chats through these groups
+        self.activity_groups = set()
+        self.user_group = None
+        self.use_msgpack = False
+        self.token_expiry_task = None
+        self.presence_task = None
+        self.idle_task = None
+        self.last_received = time.monotonic()
+        # the server buffers written frames on its own, so the backlog of a slow client is bounded here
+        # by frames which the client has not acknowledged with a pong yet. Clients opt in by echoing
+        # the frame of a ping in their pong, older clients are sent everything
+        self.flow_control = False
+        self.sent_frames = 0
+        self.acked_frames = 0
+        self.last_ping_frame = 0
+        self.resync_pending = False
+        self.rate_limit_buckets = {}
+
+    async def connect(self):
+        # chat ids are kept for the whole connection, so frames are validated without database queries
+        self.chat_ids = await get_user_chat_ids(self.scope['user'])
+        self.user_group = get_user_group_name(self.scope['user'].id)
+        if settings.CHAT_LAZY_SUBSCRIPTIONS:
+            self.activity_groups = {get_activity_group_name(chat_id) for chat_id in self.chat_ids}
+        else:
+            self.chat_groups = {str(chat_id) for chat_id in self.chat_ids}
+
+        await self.join_groups(self.chat_groups | self.activity_groups | {self.user_group})
+
+        self.use_msgpack = settings.CHAT_MSGPACK and self.MSGPACK_SUBPROTOCOL in self.scope.get('subprotocols', [])
+        await self.accept(subprotocol=self.MSGPACK_SUBPROTOCOL if self.use_msgpack else None)
+
+        self.token_expiry_task = asyncio.ensure_future(self.close_on_token_expiry())
+        self.idle_task = asyncio.ensure_future(self.close_when_idle())
+
+        await get_presence().touch(self.scope['user'].id, self.channel_name)
+        self.presence_task = asyncio.ensure_future(self.send_presence_heartbeats())
+
+    async def send_presence_heartbeats(self):
+        """
+        keeps the connection online in the presence store, entries of dead workers expire by themselves
+        """
+        while True:
+            await asyncio.sleep(settings.CHAT_PRESENCE_HEARTBEAT)
+            await get_presence().touch(self.scope['user'].id, self.channel_name)
+
+    async def close_on_token_expiry(self):
+        """
+        closes the socket when the access token expires. Token refresh moves scope['token_exp'] forward
+        """
+        while True:
+            delay = self.scope['token_exp'] - time.time()
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+
+        await self.close(code=self.TOKEN_EXPIRED_CLOSE_CODE)
+
+    async def close_when_idle(self):
+        """
+        pings a client which has been silent for CHAT_PING_INTERVAL seconds and closes the socket
+        when nothing arrives for CHAT_IDLE_TIMEOUT seconds, e.g. from a backgrounded mobile app
+        """
+        while True:
+            idle = time.monotonic() - self.last_received
+            if idle >= settings.CHAT_IDLE_TIMEOUT:
+                break
+
+            if idle >= settings.CHAT_PING_INTERVAL:
+                await self.send_ping()
+                await asyncio.sleep(settings.CHAT_IDLE_TIMEOUT - idle)
+            else:
+                await asyncio.sleep(settings.CHAT_PING_INTERVAL - idle)
+
+        metrics.increment('chat_reaped_connections')
+        # groups are discarded in disconnect, which follows the close
+        await self.close(code=self.IDLE_CLOSE_CODE)
+
+    async def disconnect(self, close_code):
+        if self.token_expiry_task:
+            self.token_expiry_task.cancel()
+
+        if self.idle_task:
+            self.idle_task.cancel()
+
+        if self.presence_task:
+            self.presence_task.cancel()
+            await get_presence().remove(self.scope['user'].id, self.channel_name)
+
+        group_names = self.chat_groups | self.activity_groups
+        if self.user_group:
+            group_names.add(self.user_group)
+
+        await self.leave_groups(group_names)
+
+    async def join_groups(self, group_names):
+        # subscriptions are issued concurrently instead of one round trip after another
+        await asyncio.gather(*[self.channel_layer.group_add(group_name, self.channel_name)
+                               for group_name in group_names])
+
+    async def leave_groups(self, group_names):
+        await asyncio.gather(*[self.channel_layer.group_discard(group_name, self.channel_name)
+                               for group_name in group_names])
+
+    async def join_chat_groups(self, chat_ids):
+        group_names = {str(chat_id) for chat_id in chat_ids} - self.chat_groups
+        await self.join_groups(group_names)
+        self.chat_groups |= group_names
+
+    async def leave_chat_groups(self, chat_ids):
+        group_names = {str(chat_id) for chat_id in chat_ids} & self.chat_groups
+        await self.leave_groups(group_names)
+        self.chat_groups -= group_names
+
+    async def chat_membership_changed(self, event):
+        """
+        refreshes cached chat ids and chat groups when the user is added to or removed from a chat
+        """
+        chat_ids = await get_user_chat_ids(self.scope['user'])
+
+        if settings.CHAT_LAZY_SUBSCRIPTIONS:
+            activity_groups = {get_activity_group_name(chat_id) for chat_id in chat_ids}
+            await asyncio.gather(self.join_groups(activity_groups - self.activity_groups),
+                                 self.leave_groups(self.activity_groups - activity_groups))
+            self.activity_groups = activity_groups
+        else:
+            await self.join_chat_groups(chat_ids - self.chat_ids)
+        await self.leave_chat_groups(self.chat_ids - chat_ids)
+
+        self.chat_ids = chat_ids
+
+    @staticmethod
+    def build_event(event_type, message, **kwargs):
+        """
+        encodes the frame once for the whole group, recipients forward it unchanged. The MessagePack
+        copy doubles the channel layer payload, so it is only added when CHAT_MSGPACK allows such sockets
+        """
         response = {
             'status': 'success',
-            'message': event['message']
+            'message': message
+        }
+
+        event = {
+            'type': event_type,
+            'text': json.dumps(response),
+            **kwargs
         }
+        if settings.CHAT_MSGPACK:
+            event['bytes'] = msgpack.packb(response)
+
+        return event
+
+    async def broadcast(self, chat_id, message):
+        event = self.build_event('success_message', message)
+
+        await self.channel_layer.group_send(str(chat_id), event)
+
+        # in lazy subscription mode the sender may write to a chat it is not subscribed to
+        if str(chat_id) not in self.chat_groups:
+            await self.success_message(event)
+
+    async def notify_chat_activity(self, message):
+        """
+        sends a lightweight unread badge to all sockets of the chat's members with one group_send
+        """
+        event = self.build_event('chat_activity', {
+            'message_type': 'chat_activity',
+            'chat_id': message['chat_id'],
+            'message_id': message['id'],
+            'date': message['date']
+        }, chat_id=message['chat_id'], user_id=self.scope['user'].id)
+
+        await self.channel_layer.group_send(get_activity_group_name(message['chat_id']), event)
+
+    async def chat_activity(self, event):
+        # subscribed sockets already got the full message, own messages are not unread
+        if str(event['chat_id']) in self.chat_groups or event['user_id'] == self.scope['user'].id:
+            return
+
+        await self.success_message(event)
 
-        await self.send(text_data=json.dumps(response))
+    async def chat_typing(self, event):
+        # typing frames are disposable, they are neither echoed to the typing user nor sent behind a backlog
+        if event['user_id'] == self.scope['user'].id:
+            return
+
+        if self.flow_control and self.get_unacked_frames() >= settings.CHAT_OUTBOUND_ACK_INTERVAL:
+            metrics.increment('chat_typing_frames_dropped')
+            return
+
+        await self.success_message(event)
+
+    async def success_message(self, event):
+        """
+        forwards a broadcast unless a flow controlled client is too far behind, replies to the client's
+        own commands are sent with send_frame and are never dropped
+        """
+        if self.flow_control:
+            unacked_frames = self.get_unacked_frames()
+            metrics.observe_max('chat_outbound_unacked_frames_max', unacked_frames)
+
+            if self.resync_pending:
+                metrics.increment('chat_outbound_frames_dropped')
+                return
+
+            if unacked_frames >= settings.CHAT_OUTBOUND_WINDOW:
+                metrics.increment('chat_outbound_frames_dropped')
+                await self.handle_slow_consumer()
+                return
+
+        if self.use_msgpack:
+            await self.send_data(bytes_data=event['bytes'])
+        else:
+            await self.send_data(text_data=event['text'])
+
+        if self.sent_frames - self.last_ping_frame >= settings.CHAT_OUTBOUND_ACK_INTERVAL:
+            await self.send_ping()
+
+    async def send_frame(self, response):
+        if self.use_msgpack:
+            await self.send_data(bytes_data=msgpack.packb(response))
+        else:
+            await self.send_data(text_data=json.dumps(response))
+
+    async def send_data(self, text_data=None, bytes_data=None):
+        self.sent_frames += 1
+        await self.send(text_data=text_data, bytes_data=bytes_data)
+
+    async def send_ping(self):
+        # frames arrive in order, so the pong to this ping proves that every frame before it has been read
+        self.last_ping_frame = self.sent_frames + 1
+
+        await self.send_frame({'status': 'success', 'message': {'message_type': 'ping', 'frame': self.last_ping_frame}})
+
+    def get_unacked_frames(self):
+        return self.sent_frames - self.acked_frames
+
+    async def handle_slow_consumer(self):
+        if settings.CHAT_OUTBOUND_OVERFLOW_POLICY == self.OVERFLOW_CLOSE:
+            metrics.increment('chat_slow_consumers_closed')
+            await self.close(code=self.SLOW_CONSUMER_CLOSE_CODE)
+            return
+
+        # broadcasts are dropped until the client acknowledges everything sent so far,
+        # then it fetches what it missed with the sync command
+        self.resync_pending = True
+        metrics.increment('chat_slow_consumers_resynced')
+
+        await self.send_frame({
+            'status': 'error',
+            'message': {
+                'message_type': 'resync',
+                'message': 'Messages were dropped, sync the chats'
+            }
+        })
+        await self.send_ping()
 
     async def send_error_message(self, message):
         response = {
@@ -130,28 +607,25 @@ class ChatConsumer(AsyncWebsocketConsumer):
             'message': message
         }
 
-        await self.send(text_data=json.dumps(response))
+        await self.send_frame(response)
 
     async def websocket_receive(self, message):
-        # invalid token
-        payload = check_token(self.scope['query_string'])
-        if not payload:
-            await self.close()
-            return
+        # any frame proves the client is alive, pong only exists for clients with nothing else to send
+        self.last_received = time.monotonic()
 
-        if 'text' not in message:
-            await self.send_error_message({'message': 'No message sent'})
+        # the token was verified at handshake, only its expiry is checked here
+        if self.scope['token_exp'] <= time.time():
+            await self.close(code=self.TOKEN_EXPIRED_CLOSE_CODE)
             return
 
-        await self.receive(text_data=message['text'])
+        if message.get('text') is not None:
+            await self.receive(text_data=message['text'])
+        elif message.get('bytes') is not None and self.use_msgpack:
+            await self.receive(bytes_data=message['bytes'])
+        else:
+            await self.send_error_message({'message': 'No message sent'})
 
     async def validate_payload(self, payload):
-        if not payload['chat_id']:
-            return {'chat': 'No chat_id specified'}
-
-        if not await is_chat_member(self.scope['user'], payload['chat_id']):
-            return {'chat_id': 'You are not member of this chat'}
-
         if 'message_type' not in payload:
             return {'message_type': 'message_type not specified'}
 
@@ -159,21 +633,88 @@ class ChatConsumer(AsyncWebsocketConsumer):
             return {'message_type': f'Wrong message type. '
                                     f'Allowed types: {", ".join(self.ALLOWED_MESSAGE_TYPES)}'}
 
-        if not await check_chat_id(payload['chat_id']):
-            return {'chat_id': f'Chat with id {payload["chat_id"]} not found'}
+        errors = self.check_rate_limit(payload['message_type'])
+        if errors:
+            return errors
+
+        if payload['message_type'] in self.CHAT_MESSAGE_TYPES:
+            return self.validate_chat_id(payload)
+
+    def check_rate_limit(self, message_type):
+        """
+        rejects frames over the per-connection or per-user limit before any database work
+        """
+        buckets = []
+
+        if message_type in settings.CHAT_RATE_LIMITS:
+            if message_type not in self.rate_limit_buckets:
+                self.rate_limit_buckets[message_type] = TokenBucket(*settings.CHAT_RATE_LIMITS[message_type])
+            buckets.append(self.rate_limit_buckets[message_type])
+
+        if message_type in settings.CHAT_USER_RATE_LIMITS:
+            key = (self.scope['user'].id, message_type)
+            bucket = user_rate_limit_buckets.get(key) or TokenBucket(*settings.CHAT_USER_RATE_LIMITS[message_type])
+            # setting again keeps buckets of active users from expiring
+            user_rate_limit_buckets.set(key, bucket)
+            buckets.append(bucket)
+
+        for bucket in buckets:
+            if bucket.retry_after() > 0:
+                metrics.increment('chat_rate_limited_frames')
+                return {
+                    'message_type': message_type,
+                    'rate_limit': f'Too many {message_type} messages',
+                    'retry_after': round(bucket.retry_after(), 3)
+                }
+
+        for bucket in buckets:
+            bucket.consume()
+
+    def validate_chat_id(self, payload):
+        if not payload.get('chat_id'):
+            return {'chat': 'No chat_id specified'}
 
-    async def validate_message_id(self, data):
+        try:
+            payload['chat_id'] = int(payload['chat_id'])
+        except (TypeError, ValueError):
+            return {'chat_id': 'Wrong chat_id type'}
+
+        if payload['chat_id'] not in self.chat_ids:
+            return {'chat_id': 'You are not member of this chat'}
+
+    def validate_message_id(self, data):
+        # ownership is checked inside the command's unit of work
         if 'message_id' not in data or not isinstance(data['message_id'], int):
             return {'message_id': 'No message id specified or specified wrong type'}
 
-        if not await is_message_owner(self.scope['user'], data['message_id']):
-            return {'message_id': 'You are trying to modify not your message'}
+    def validate_client_side_id(self, data):
+        client_side_id = data.get('client_side_id')
+        if client_side_id is not None and \
+                (not isinstance(client_side_id, (str, int)) or len(str(client_side_id)) > 64):
+            return {'client_side_id': 'client_side_id must be a string or an integer up to 64 characters'}
+
+    def validate_attachments(self, data):
+        for field in ['files', 'articles']:
+            if field not in data:
+                continue
+
+            if not isinstance(data[field], list) or not all(str(pk).isdigit() for pk in data[field]):
+                return {field: f'{field} must be a list of ids'}
 
     # Receive message from WebSocket
     async def receive(self, text_data=None, bytes_data=None):
-        data = json.loads(text_data)
+        try:
+            if bytes_data is not None:
+                # integer map keys are allowed, e.g. chat ids of the sync command
+                data = msgpack.unpackb(bytes_data, strict_map_key=False)
+            else:
+                data = json.loads(text_data)
+        except (ValueError, TypeError):
+            # msgpack raises TypeError for unhashable map keys, e.g. arrays
+            await self.send_error_message({'message': 'Wrong message format'})
+            return
 
-        if 'message' not in data:
+        if not isinstance(data, dict) or not isinstance(data.get('message'), dict):
             await self.send_error_message({'message': 'No message sent'})
             return
 
@@ -185,79 +726,257 @@ class ChatConsumer(AsyncWebsocketConsumer):
             await self.send_error_message(errors)
             return
 
-        if payload['message_type'] == 'new_message':
-            await self.new_message(payload)
-        elif payload['message_type'] == 'update_message':
-            await self.update_message(payload)
-        elif payload['message_type'] == 'delete_message':
-            await self.delete_message(payload)
+        # every allowed message type has a handler with the same name
+        await getattr(self, payload['message_type'])(payload)
 
-    async def new_message(self, payload):
-        message, errors = await save_new_message(payload, self.scope)
+    def validate_chat_ids(self, payload):
+        chat_ids = payload.get('chat_ids')
+        if not isinstance(chat_ids, list) or not all(isinstance(chat_id, int) for chat_id in chat_ids):
+            return None, {'chat_ids': 'No chat_ids specified or specified wrong type'}
+
+        not_member_ids = [chat_id for chat_id in chat_ids if chat_id not in self.chat_ids]
+        if not_member_ids:
+            return None, {'chat_ids': f'You are not member of the following chats: '
+                                      f'{", ".join(map(str, not_member_ids))}'}
 
-        response = await serialize_message(message)
+        return chat_ids, None
+
+    async def send_subscriptions(self, payload):
+        response = {
+            'status': 'success',
+            'message': {
+                'message_type': payload['message_type'],
+                'chat_ids': sorted(int(group_name) for group_name in self.chat_groups)
+            }
+        }
 
+        await self.send_frame(response)
+
+    async def subscribe(self, payload):
+        chat_ids, errors = self.validate_chat_ids(payload)
         if errors:
-            response['errors'] = errors
+            await self.send_error_message(errors)
+            return
+
+        if len(self.chat_groups | {str(chat_id) for chat_id in chat_ids}) > settings.CHAT_MAX_SUBSCRIPTIONS:
+            await self.send_error_message({'chat_ids': f'Subscriptions limit is {settings.CHAT_MAX_SUBSCRIPTIONS}'})
+            return
+
+        await self.join_chat_groups(chat_ids)
+        await self.send_subscriptions(payload)
+
+    async def unsubscribe(self, payload):
+        chat_ids, errors = self.validate_chat_ids(payload)
+        if errors:
+            await self.send_error_message(errors)
+            return
+
+        await self.leave_chat_groups(chat_ids)
+        await self.send_subscriptions(payload)
+
+    def validate_sync_positions(self, payload):
+        chats = payload.get('chats')
+        if not isinstance(chats, dict) or not chats:
+            return None, {'chats': 'Specify chats as {chat_id: last_seen_message_id}'}
+
+        positions = {}
+        for chat_id, message_id in chats.items():
+            try:
+                positions[int(chat_id)] = int(message_id or 0)
+            except (TypeError, ValueError):
+                return None, {'chats': 'Chat ids and message ids must be integers'}
+
+        not_member_ids = [chat_id for chat_id in positions if chat_id not in self.chat_ids]
+        if not_member_ids:
+            return None, {'chats': f'You are not member of the following chats: '
+                                   f'{", ".join(map(str, not_member_ids))}'}
+
+        return positions, None
+
+    async def sync(self, payload):
+        """
+        returns messages missed since the last seen ones, the client repeats sync while has_more is true
+        """
+        positions, errors = self.validate_sync_positions(payload)
+        if errors:
+            await self.send_error_message(errors)
+            return
+
+        messages, has_more = await get_missed_messages(positions, settings.CHAT_SYNC_MAX_MESSAGES)
+
+        await self.send_frame({
+            'status': 'success',
+            'message': {
+                'message_type': payload['message_type'],
+                'messages': messages,
+                'has_more': has_more
+            }
+        })
+
+    async def ping(self, payload):
+        await self.send_frame({'status': 'success', 'message': {'message_type': 'pong'}})
+
+    async def pong(self, payload):
+        """
+        acknowledges the frames up to the echoed ping frame and turns flow control on,
+        a pong without a frame only keeps the connection alive
+        """
+        frame = payload.get('frame')
+        if not isinstance(frame, int) or isinstance(frame, bool):
+            return
+
+        self.flow_control = True
+        self.acked_frames = max(self.acked_frames, min(frame, self.last_ping_frame))
+
+        if self.resync_pending and self.acked_frames >= self.last_ping_frame:
+            self.resync_pending = False
+
+    async def refresh_token(self, payload):
+        token_payload = decode_token(payload.get('access', ''))
+
+        if not token_payload or token_payload.get('token_type') != 'access' or \
+                int(token_payload['user_id']) != self.scope['user'].id:
+            await self.send_error_message({'access': 'Invalid access token'})
+            return
+
+        self.scope['token_payload'] = token_payload
+        self.scope['token_exp'] = token_payload['exp']
+
+        response = {
+            'status': 'success',
+            'message': {
+                'message_type': payload['message_type'],
+                'exp': token_payload['exp']
+            }
+        }
+
+        await self.send_frame(response)
+
+    async def send_duplicate_message(self, response):
+        # a retried send is answered only to the sender, the original has already been broadcast
+        await self.send_frame({
+            'status': 'success',
+            'message': {**response, 'duplicate': True}
+        })
+
+    async def new_message(self, payload):
+        errors = self.validate_attachments(payload) or self.validate_client_side_id(payload)
+        if errors:
+            await self.send_error_message(errors)
+            return
+
+        dedupe_key = get_dedupe_key(payload, self.scope['user'])
+
+        response = sent_messages.get(dedupe_key) if dedupe_key else None
+        if response:
+            await self.send_duplicate_message(response)
+            return
+
+        try:
+            if settings.CHAT_WRITE_BEHIND:
+                # resolves after the batch is committed, so the broadcast never announces an unsaved message
+                saved_message = await message_buffer.submit((payload, self.scope['user']))
+            else:
+                saved_message = await save_new_message(payload, self.scope['user'])
+        except DatabaseError:
+            logger.exception('Failed to save a new message of user %s in chat %s',
+                             self.scope['user'].id, payload['chat_id'])
+            await self.send_error_message({'message': 'Message could not be saved'})
+            return
+
+        response = saved_message.response
+
+        if saved_message.errors:
+            response['errors'] = saved_message.errors
 
         if 'client_side_id' in payload:
             response['client_side_id'] = payload['client_side_id']
 
         response['message_type'] = payload['message_type']
 
-        await self.channel_layer.group_send(
-            str(payload['chat_id']),
-            {
-                'type': 'success_message',
-                'message': response
-            }
-        )
+        if dedupe_key:
+            sent_messages.set(dedupe_key, response)
+
+        # the next keystroke starts a new indicator right away
+        typing_users.pop((payload['chat_id'], self.scope['user'].id))
+
+        if saved_message.duplicate:
+            await self.send_duplicate_message(response)
+            return
+
+        await self.broadcast(payload['chat_id'], response)
+
+        if settings.CHAT_LAZY_SUBSCRIPTIONS:
+            await self.notify_chat_activity(response)
 
     async def update_message(self, payload):
-        errors = await self.validate_message_id(payload)
+        errors = self.validate_message_id(payload) or self.validate_attachments(payload)
         if errors:
             await self.send_error_message(errors)
             return
 
-        message, errors = await update_message(payload)
-        if not message:
+        response, errors = await update_message(payload, self.scope['user'])
+        if not response:
             await self.send_error_message(errors)
             return
 
-        response = await serialize_message(message)
-
         if errors:
             response['errors'] = errors
 
         response['message_type'] = payload['message_type']
 
-        await self.channel_layer.group_send(
-            str(payload['chat_id']),
-            {
-                'type': 'success_message',
-                'message': response
-            }
-        )
+        await self.broadcast(payload['chat_id'], response)
 
     async def delete_message(self, payload):
-        errors = await self.validate_message_id(payload)
+        errors = self.validate_message_id(payload)
         if errors:
             await self.send_error_message(errors)
             return
 
-        errors = await delete_message(payload)
+        seq, errors = await delete_message(payload, self.scope['user'])
 
         if errors:
             await self.send_error_message(errors)
             return
 
-        response = {'message_id': payload['message_id'], 'chat_id': payload['chat_id'],
+        response = {'message_id': payload['message_id'], 'chat_id': payload['chat_id'], 'seq': seq,
                     'message_type': payload['message_type']}
 
-        await self.channel_layer.group_send(
-            str(payload['chat_id']),
-            {
-                'type': 'success_message',
-                'message': response
-            }
-        )
+        await self.broadcast(payload['chat_id'], response)
+
+    async def typing(self, payload):
+        """
+        announces that the user is typing, repeated events within CHAT_TYPING_WINDOW are coalesced
+        into one group send. Nothing is stored, clients hide the indicator after expires_in seconds
+        """
+        key = (payload['chat_id'], self.scope['user'].id)
+        if key in typing_users:
+            metrics.increment('chat_typing_frames_coalesced')
+            return
+
+        typing_users.set(key, True)
+
+        event = self.build_event('chat_typing', {
+            'message_type': payload['message_type'],
+            'chat_id': payload['chat_id'],
+            'user_id': self.scope['user'].id,
+            'expires_in': settings.CHAT_TYPING_TTL
+        }, user_id=self.scope['user'].id)
+
+        await self.channel_layer.group_send(str(payload['chat_id']), event)
+
+    async def read(self, payload):
+        """
+        read receipt. Positions are coalesced for CHAT_READ_FLUSH_DELAY seconds and written in one batch
+        """
+        errors = self.validate_message_id(payload)
+        if not errors and not 0 < payload['message_id'] <= self.MAX_MESSAGE_ID:
+            errors = {'message_id': 'Message id is out of range'}
+        if errors:
+            await self.send_error_message(errors)
+            return
+
+        if payload['message_id'] <= read_positions.get((payload['chat_id'], self.scope['user'].id), 0):
+            return
+
+        read_position_buffer.submit(payload['chat_id'], self.scope['user'].id, payload['message_id'])
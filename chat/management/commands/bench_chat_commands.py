@@ -0,0 +1,70 @@
+import statistics
+import time
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from django.core.management import BaseCommand
+from chat.models import File
+from chat.utils.benchmark import benchmark_environment, connect, create_benchmark_chat, percentile
+
+
+class Command(BaseCommand):
+    help = 'Measures p50/p99 latency of ChatConsumer commands against a throwaway test database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=200)
+        parser.add_argument('--files', type=int, default=5, help='Files attached to every new message')
+
+    def handle(self, *args, **options):
+        with benchmark_environment():
+            timings = async_to_sync(self.run_benchmark)(options['iterations'], options['files'])
+
+        self.stdout.write(f'{"command":<16}{"p50, ms":>10}{"p99, ms":>10}{"mean, ms":>10}')
+        for command, values in timings.items():
+            self.stdout.write(f'{command:<16}{percentile(values, 50) * 1000:>10.2f}'
+                              f'{percentile(values, 99) * 1000:>10.2f}{statistics.mean(values) * 1000:>10.2f}')
+
+    @database_sync_to_async
+    def create_files(self, chat, count):
+        File.objects.bulk_create([File(chat=chat, file=f'bench/{i}.txt') for i in range(count)])
+        return [str(pk) for pk in File.objects.filter(chat=chat, message=None).values_list('id', flat=True)]
+
+    async def run_command(self, communicator, payload):
+        start = time.perf_counter()
+        await communicator.send_json_to({'message': payload})
+        response = await communicator.receive_json_from(timeout=10)
+        elapsed = time.perf_counter() - start
+
+        if response['status'] != 'success':
+            raise RuntimeError(f'{payload["message_type"]} failed: {response["message"]}')
+
+        return response['message'], elapsed
+
+    async def run_benchmark(self, iterations, files):
+        user, chat = await create_benchmark_chat()
+        communicator = await connect(user)
+
+        timings = {'new_message': [], 'update_message': [], 'delete_message': []}
+
+        for i in range(iterations):
+            file_ids = await self.create_files(chat, files)
+
+            message, elapsed = await self.run_command(communicator, {
+                'message_type': 'new_message', 'chat_id': chat.id, 'text': f'message {i}',
+                'files': file_ids, 'client_side_id': i
+            })
+            timings['new_message'].append(elapsed)
+
+            _, elapsed = await self.run_command(communicator, {
+                'message_type': 'update_message', 'chat_id': chat.id, 'message_id': message['id'],
+                'text': f'updated {i}', 'files': file_ids
+            })
+            timings['update_message'].append(elapsed)
+
+            _, elapsed = await self.run_command(communicator, {
+                'message_type': 'delete_message', 'chat_id': chat.id, 'message_id': message['id']
+            })
+            timings['delete_message'].append(elapsed)
+
+        await communicator.disconnect()
+
+        return timings
@@ -0,0 +1,57 @@
+import asyncio
+import statistics
+import time
+from asgiref.sync import async_to_sync
+from django.core.management import BaseCommand
+from chat.utils.benchmark import benchmark_environment, connect, create_benchmark_chat, percentile
+
+
+class Command(BaseCommand):
+    help = 'Measures CPU cost of broadcasting one chat message as the number of group members grows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--group-sizes', default='10,50,100,300',
+                            help='Comma separated numbers of sockets subscribed to the chat')
+        parser.add_argument('--iterations', type=int, default=20, help='Messages sent for every group size')
+        parser.add_argument('--text-size', type=int, default=1000, help='Length of every message text')
+
+    def handle(self, *args, **options):
+        group_sizes = [int(size) for size in options['group_sizes'].split(',')]
+
+        with benchmark_environment():
+            results = async_to_sync(self.run_benchmark)(group_sizes, options['iterations'], options['text_size'])
+
+        self.stdout.write(f'{"sockets":<10}{"wall p50, ms":>14}{"cpu p50, ms":>14}{"cpu per socket, us":>20}')
+        for group_size, (wall, cpu) in results.items():
+            self.stdout.write(f'{group_size:<10}{percentile(wall, 50) * 1000:>14.2f}'
+                              f'{percentile(cpu, 50) * 1000:>14.2f}'
+                              f'{statistics.mean(cpu) / group_size * 1000000:>20.1f}')
+
+    async def run_benchmark(self, group_sizes, iterations, text_size):
+        user, chat = await create_benchmark_chat()
+        text = 'x' * text_size
+        results = {}
+
+        for group_size in group_sizes:
+            communicators = [await connect(user) for _ in range(group_size)]
+            sender = communicators[0]
+            wall, cpu = [], []
+
+            for i in range(iterations):
+                start_wall, start_cpu = time.perf_counter(), time.process_time()
+
+                await sender.send_json_to({'message': {
+                    'message_type': 'new_message', 'chat_id': chat.id, 'text': text,
+                    'client_side_id': f'{group_size}-{i}'
+                }})
+                await asyncio.gather(*[communicator.receive_from(timeout=30) for communicator in communicators])
+
+                wall.append(time.perf_counter() - start_wall)
+                cpu.append(time.process_time() - start_cpu)
+
+            for communicator in communicators:
+                await communicator.disconnect()
+
+            results[group_size] = (wall, cpu)
+
+        return results
@@ -0,0 +1,22 @@
+# Generated by Django 3.2.9 on 2026-10-18 13:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_alter_message_text'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='client_side_id',
+            field=models.CharField(blank=True, default=None, max_length=64, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('user', 'client_side_id'), name='unique_message_client_side_id'),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 3.2.9 on 2026-10-18 13:40
+
+from django.db import migrations, models
+
+
+def fill_message_seqs(apps, schema_editor):
+    Chat = apps.get_model('chat', 'Chat')
+    Message = apps.get_model('chat', 'Message')
+
+    for chat in Chat.objects.all():
+        messages = list(Message.objects.filter(chat=chat).order_by('date', 'id'))
+        for seq, message in enumerate(messages, start=1):
+            message.seq = seq
+        Message.objects.bulk_update(messages, ['seq'], batch_size=1000)
+
+        chat.last_seq = len(messages)
+        chat.save(update_fields=['last_seq'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_message_chat_id_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='last_seq',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='seq',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.RunPython(fill_message_seqs, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='message',
+            name='seq',
+            field=models.PositiveIntegerField(),
+        ),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('chat', 'seq'), name='unique_message_chat_seq'),
+        ),
+    ]
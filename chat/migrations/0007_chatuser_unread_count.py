@@ -0,0 +1,31 @@
+# Generated by Django 3.2.9 on 2026-10-18 15:10
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def fill_unread_counts(apps, schema_editor):
+    ChatUser = apps.get_model('chat', 'ChatUser')
+    Message = apps.get_model('chat', 'Message')
+
+    messages = Message.objects.filter(chat_id=OuterRef('chat_id'), id__gt=Coalesce(OuterRef('last_read'), 0)) \
+        .exclude(user_id=OuterRef('user_id')).order_by().values('chat_id').annotate(count=Count('id'))
+
+    ChatUser.objects.update(unread_count=Coalesce(Subquery(messages.values('count')), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_message_seq'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatuser',
+            name='unread_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_unread_counts, migrations.RunPython.noop),
+    ]
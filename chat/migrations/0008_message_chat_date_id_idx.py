@@ -0,0 +1,17 @@
+# Generated by Django 3.2.9 on 2026-10-18 13:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_chatuser_unread_count'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chat', 'date', 'id'], name='message_chat_date_id_idx'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 3.2.9 on 2026-10-18 13:27
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+import django.db.models.deletion
+
+
+def fill_chat_summaries(apps, schema_editor):
+    Chat = apps.get_model('chat', 'Chat')
+    Message = apps.get_model('chat', 'Message')
+
+    messages = Message.objects.filter(chat_id=OuterRef('pk')).order_by()
+    message_counts = messages.values('chat_id').annotate(count=Count('id')).values('count')
+
+    Chat.objects.update(last_message=Subquery(messages.order_by('-id').values('id')[:1]),
+                        message_count=Coalesce(Subquery(message_counts), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_message_chat_date_id_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='last_message',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.message'),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_chat_summaries, migrations.RunPython.noop),
+    ]
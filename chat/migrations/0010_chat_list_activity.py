@@ -0,0 +1,41 @@
+# Generated by Django 3.2.9 on 2026-10-18 13:29
+
+import chat.models
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+import django.utils.timezone
+
+
+def fill_last_activity(apps, schema_editor):
+    ChatUser = apps.get_model('chat', 'ChatUser')
+    Message = apps.get_model('chat', 'Message')
+
+    last_message_dates = Message.objects.filter(chat_id=OuterRef('chat_id')).order_by('-id').values('date')[:1]
+
+    ChatUser.objects.update(last_activity=Coalesce(Subquery(last_message_dates), F('last_activity')))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_chat_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='version',
+            field=models.BigIntegerField(db_index=True, default=chat.models.get_summary_version),
+        ),
+        migrations.AddField(
+            model_name='chatuser',
+            name='last_activity',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(fill_last_activity, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='chatuser',
+            index=models.Index(fields=['user', '-last_activity', '-chat'], name='chatuser_user_activity_idx'),
+        ),
+    ]
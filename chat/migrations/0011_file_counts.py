@@ -0,0 +1,41 @@
+# Generated by Django 3.2.9 on 2026-10-18 13:31
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def fill_file_counts(apps, schema_editor):
+    Chat = apps.get_model('chat', 'Chat')
+    File = apps.get_model('chat', 'File')
+
+    def count_files(file_type):
+        files = File.objects.filter(chat_id=OuterRef('pk'), file_type=file_type).order_by()
+        return Coalesce(Subquery(files.values('chat_id').annotate(count=Count('id')).values('count')), 0)
+
+    Chat.objects.update(image_count=count_files('IMG'), document_count=count_files('DOC'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0010_chat_list_activity'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='document_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='image_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='file',
+            index=models.Index(fields=['chat', 'file_type', 'id'], name='file_chat_type_id_idx'),
+        ),
+        migrations.RunPython(fill_file_counts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.2.9 on 2026-10-18 13:33
+
+import chat.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0011_file_counts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='preview',
+            field=models.ImageField(blank=True, default=None, max_length=255, null=True, upload_to=chat.models.get_file_path),
+        ),
+        migrations.AddField(
+            model_name='file',
+            name='thumbnail',
+            field=models.ImageField(blank=True, default=None, max_length=255, null=True, upload_to=chat.models.get_file_path),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.2.9 on 2026-10-18 14:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0012_file_previews'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='message',
+            name='unique_message_client_side_id',
+        ),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('user', 'chat', 'client_side_id'), name='unique_message_client_side_id'),
+        ),
+    ]
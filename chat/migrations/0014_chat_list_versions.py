@@ -0,0 +1,56 @@
+# Generated by Django 3.2.9 on 2026-10-18 14:09
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max
+import django.db.models.deletion
+
+
+def create_counter(apps, schema_editor):
+    Chat = apps.get_model('chat', 'Chat')
+    ChatListVersion = apps.get_model('chat', 'ChatListVersion')
+
+    # new versions continue after the time based ones, so changed_since values of clients stay valid
+    last_version = Chat.objects.aggregate(version=Max('version'))['version'] or 0
+    ChatListVersion.objects.create(pk=1, value=last_version)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0013_message_client_side_id_chat'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatListVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(create_counter, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='chat',
+            name='version',
+            field=models.BigIntegerField(db_index=True, default=0),
+        ),
+        migrations.CreateModel(
+            name='RemovedChat',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chat_id', models.IntegerField()),
+                ('version', models.BigIntegerField()),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='removedchat',
+            index=models.Index(fields=['user', 'version'], name='removed_chat_user_version_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='removedchat',
+            constraint=models.UniqueConstraint(fields=('user', 'chat_id'), name='unique_removed_chat'),
+        ),
+    ]
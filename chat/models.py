@@ -1,13 +1,47 @@
+import logging
 import os
+import threading
+import time
+from functools import partial
+from django.core.files.base import ContentFile
 from django.core.files.images import ImageFile
-from django.db import models
+from django.db import DatabaseError, models, transaction
+from django.db.models import Case, Count, F, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce
 from users.models import User
 from django.utils import timezone
 from college.utils.picture_generator import generate_picture
 from college.utils import aws_supplier, file_cleaner
+from .utils.thumbnails import generate_previews
 from django.conf import settings
 
 
+logger = logging.getLogger(__name__)
+
+# batch of ChatListChanges of the current thread's transaction
+pending_changes = threading.local()
+
+
+def get_summary_version():
+    # initial versions of chats which existed before ChatListVersion, used by migration 0010
+    return time.time_ns() // 1000
+
+
+def get_pending_changes():
+    """
+    returns the ChatListChanges of the current transaction and whether they were just created.
+    Changes whose callback was discarded by a rollback or has already run are not reused
+    """
+    changes = getattr(pending_changes, 'batch', None)
+    if changes and not changes.assigned and \
+            any(callback == changes.assign_versions for _, callback in transaction.get_connection().run_on_commit):
+        return changes, False
+
+    pending_changes.batch = ChatListChanges()
+
+    return pending_changes.batch, True
+
+
 def get_cover_path(self, filename):
     return f'{self.title}/{filename}'
 
@@ -16,6 +50,18 @@ class Chat(models.Model):
     users = models.ManyToManyField(User, through='ChatUser', related_name='chats')
     cover = models.ImageField(upload_to=get_cover_path, null=True, default=None)
     title = models.CharField(max_length=255, unique=True)
+    # sequence number of the last message in the chat
+    last_seq = models.PositiveIntegerField(default=0)
+    # summary for the chat list, maintained when messages are created and deleted. Text, date and author
+    # are joined from the message, so edits need no maintenance and the preview never goes stale
+    last_message = models.ForeignKey('Message', on_delete=models.SET_NULL, null=True, related_name='+')
+    message_count = models.PositiveIntegerField(default=0)
+    # numbers of files by type for the gallery, maintained when files are uploaded and deleted
+    image_count = models.PositiveIntegerField(default=0)
+    document_count = models.PositiveIntegerField(default=0)
+    # moves forward whenever the chat list entry changes, clients pass the largest seen one as changed_since.
+    # Assigned after commit from ChatListVersion, 0 until then
+    version = models.BigIntegerField(default=0, db_index=True)
 
     def __init__(self, *args, create_cover=True, **kwargs):
         super().__init__(*args, **kwargs)
@@ -41,17 +87,67 @@ class Chat(models.Model):
             self.generate_picture()
 
         super().save(force_insert, force_update, using, update_fields)
+        Chat.mark_changed(self.pk)
 
     def update_members(self, valid_members):
         current_members = set(self.users.all())
         # if valid members are User child models set difference does not recognize them
         valid_members = [User.objects.get(pk=member.id) for member in valid_members]
 
-        for invalid_member in set(current_members) - set(valid_members):
-            ChatUser.objects.filter(chat=self, user=invalid_member).delete()
-
-        for not_included_member in set(valid_members) - set(current_members):
-            ChatUser.objects.create(chat=self, user=not_included_member)
+        # one transaction, so open sockets of all changed members are notified in one batch
+        with transaction.atomic():
+            for invalid_member in set(current_members) - set(valid_members):
+                ChatUser.objects.filter(chat=self, user=invalid_member).delete()
+
+            for not_included_member in set(valid_members) - set(current_members):
+                ChatUser.objects.create(chat=self, user=not_included_member)
+
+    @staticmethod
+    def allocate_message_seqs(chat_id, count):
+        """
+        reserves `count` consecutive message sequence numbers and returns the first one.
+        Must run inside the transaction which saves the messages, so a rollback leaves no gaps
+        """
+        Chat.objects.filter(pk=chat_id).update(last_seq=F('last_seq') + count)
+        last_seq = Chat.objects.filter(pk=chat_id).values_list('last_seq', flat=True).get()
+
+        return last_seq - count + 1
+
+    @staticmethod
+    def update_summary(chat_id, count_change):
+        """
+        points the summary to the newest message and adjusts the number of messages with one UPDATE
+        """
+        newest_message = Message.objects.filter(chat_id=OuterRef('pk')).order_by('-id').values('id')[:1]
+
+        Chat.objects.filter(pk=chat_id).update(last_message=Subquery(newest_message),
+                                               message_count=F('message_count') + count_change)
+        Chat.mark_changed(chat_id)
+
+    @staticmethod
+    def mark_changed(chat_id, member_id=None):
+        """
+        schedules a new version for the chat list entry once the current transaction commits.
+        `member_id` is a user who joined or left the chat, leaving users get a RemovedChat record
+        """
+        changes, created = get_pending_changes()
+        changes.chat_ids.add(chat_id)
+        if member_id is not None:
+            changes.members.add((chat_id, member_id))
+
+        # registered after the first change, outside of transactions the callback runs right away
+        if created:
+            transaction.on_commit(changes.assign_versions)
+
+    @staticmethod
+    def update_file_counts(chat_id, count_changes):
+        """
+        applies {file type: change} to the file counters with one UPDATE
+        """
+        Chat.objects.filter(pk=chat_id).update(**{
+            File.COUNT_FIELDS[file_type]: F(File.COUNT_FIELDS[file_type]) + change
+            for file_type, change in count_changes.items()
+        })
 
     def delete(self, using=None, keep_parents=False):
         file_cleaner.delete_assigned_file(self.cover)
@@ -60,120 +156,293 @@ class Chat(models.Model):
         return super().delete(using, keep_parents)
 
 
+def split_found_ids(queryset, ids):
+    """
+    looks up all ids with one query. Returns found ids and not found ones in the requested order
+    """
+    ids = [int(pk) for pk in ids]
+    found_ids = set(queryset.filter(pk__in=ids).values_list('id', flat=True))
+
+    return found_ids, [pk for pk in ids if pk not in found_ids]
+
+
+class MessageQuerySet(models.QuerySet):
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+
+        with transaction.atomic(using=self.db):
+            messages_by_chat = {}
+            for message in objs:
+                if message.seq is None:
+                    messages_by_chat.setdefault(message.chat_id, []).append(message)
+
+            for chat_id, messages in messages_by_chat.items():
+                first_seq = Chat.allocate_message_seqs(chat_id, len(messages))
+                for seq, message in enumerate(messages, start=first_seq):
+                    message.seq = seq
+
+            objs = super().bulk_create(objs, *args, **kwargs)
+
+            sender_counts = {}
+            for message in objs:
+                chat_counts = sender_counts.setdefault(message.chat_id, {})
+                chat_counts[message.user_id] = chat_counts.get(message.user_id, 0) + 1
+
+            for chat_id, chat_counts in sender_counts.items():
+                ChatUser.record_new_messages(chat_id, chat_counts)
+                Chat.update_summary(chat_id, sum(chat_counts.values()))
+
+            return objs
+
+
 class Message(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='messages')
     text = models.TextField(blank=True)
     date = models.DateTimeField(default=timezone.now, db_index=True)
     articles = models.ManyToManyField('wiki.Article')
+    # generated by the client, a retried send with the same id to the same chat does not create a duplicate.
+    # The id is released when it is reused after CHAT_DEDUPE_TTL seconds
+    client_side_id = models.CharField(max_length=64, null=True, blank=True, default=None)
+    # dense per chat number, lets clients order messages and detect missed broadcasts
+    seq = models.PositiveIntegerField()
+
+    objects = MessageQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'chat', 'client_side_id'], name='unique_message_client_side_id'),
+            models.UniqueConstraint(fields=['chat', 'seq'], name='unique_message_chat_seq'),
+        ]
+        indexes = [
+            # messages newer than the last seen one, used by the sync command
+            models.Index(fields=['chat', 'id'], name='message_chat_id_idx'),
+            # history pages of a chat ordered by date, id keeps the order stable on equal dates
+            models.Index(fields=['chat', 'date', 'id'], name='message_chat_date_id_idx'),
+        ]
 
     def add_articles(self, article_ids):
         # circular import
         article_model = self.articles.model
-        not_found_ids = []
-        for article_id in article_ids:
-            try:
-                article = article_model.objects.get(pk=int(article_id))
-            except article_model.DoesNotExist:
-                not_found_ids.append(str(article_id))
-                continue
-
-            self.articles.add(article)
-
-        return not_found_ids
-    
+        found_ids, not_found_ids = split_found_ids(article_model.objects.all(), article_ids)
+
+        self.articles.add(*found_ids)
+
+        return [str(article_id) for article_id in not_found_ids]
+
     def update_articles(self, article_ids):
         # circular import
         article_model = self.articles.model
-        current_articles = set([file['id'] for file in self.articles.all().values('id')])
+        current_articles = set(self.articles.values_list('id', flat=True))
         valid_articles = set([int(article_id) for article_id in article_ids])
 
-        not_included_articles = []
-        not_deleted_articles = []
-
-        for invalid_article in current_articles - valid_articles:
-            article = self.articles.filter(pk=invalid_article).first()
-            if not article:
-                not_deleted_articles.append(invalid_article)
-                continue
-            article.delete()
+        # only the links are removed, articles themselves belong to the wiki
+        self.articles.remove(*(current_articles - valid_articles))
 
-        for valid_article in valid_articles - current_articles:
-            article = article_model.objects.filter(pk=valid_article).first()
-            if not article:
-                not_included_articles.append(valid_article)
-                continue
-            self.articles.add(article)
+        found_ids, not_included_articles = split_found_ids(article_model.objects.all(),
+                                                           valid_articles - current_articles)
+        self.articles.add(*found_ids)
 
         errors = {}
         if len(not_included_articles):
             errors['not_included_articles'] = not_included_articles
-        if len(not_deleted_articles):
-            errors['not_deleted_articles'] = not_deleted_articles
 
         return errors if len(errors) else None
-    
+
     def add_files(self, file_ids):
-        not_found_ids = []
-        for file_id in file_ids:
-            try:
-                file = File.objects.get(pk=int(file_id))
-            except File.DoesNotExist:
-                not_found_ids.append(str(file_id))
-                continue
+        found_ids, not_found_ids = split_found_ids(File.objects.all(), file_ids)
 
-            self.files.add(file)
+        File.objects.filter(pk__in=found_ids).update(message=self)
 
-        return not_found_ids
+        return [str(file_id) for file_id in not_found_ids]
 
     def update_files(self, file_ids):
-        current_files = set([file['id'] for file in self.files.all().values('id')])
+        current_files = set(self.files.values_list('id', flat=True))
         valid_files = set([int(file_id) for file_id in file_ids])
 
-        not_included_files = []
-        not_deleted_files = []
-
-        for invalid_file in current_files - valid_files:
-            file = self.files.filter(pk=invalid_file).first()
-            if not file:
-                not_deleted_files.append(invalid_file)
-                continue
-            file.delete()
+        removed_files = File.objects.filter(message=self, pk__in=current_files - valid_files)
+        count_changes = {}
+        for file in removed_files:
+            file.delete_stored_files()
+            count_changes[file.file_type] = count_changes.get(file.file_type, 0) - 1
+        removed_files.delete()
+        if count_changes:
+            Chat.update_file_counts(self.chat_id, count_changes)
 
-        for valid_file in valid_files - current_files:
-            file = File.objects.filter(pk=valid_file).first()
-            if not file:
-                not_included_files.append(valid_file)
-                continue
-            self.files.add(file)
+        found_ids, not_included_files = split_found_ids(File.objects.all(), valid_files - current_files)
+        File.objects.filter(pk__in=found_ids).update(message=self)
 
         errors = {}
         if len(not_included_files):
             errors['not_included_files'] = not_included_files
-        if len(not_deleted_files):
-            errors['not_deleted_files'] = not_deleted_files
 
         return errors if len(errors) else None
 
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            adding = self._state.adding
+            if self.seq is None:
+                self.seq = Chat.allocate_message_seqs(self.chat_id, 1)
+
+            super().save(*args, **kwargs)
+
+            if adding:
+                ChatUser.record_new_messages(self.chat_id, {self.user_id: 1})
+                Chat.update_summary(self.chat_id, 1)
+            elif Chat.objects.filter(pk=self.chat_id, last_message=self.pk).exists():
+                # an edited preview changes the chat list entry
+                Chat.mark_changed(self.chat_id)
+
     def delete(self, using=None, keep_parents=False):
         for file in self.files.all():
             file.delete()
-        super().delete(using, keep_parents)
+
+        with transaction.atomic():
+            # members who have not read the message yet have it counted
+            ChatUser.objects.filter(chat_id=self.chat_id, unread_count__gt=0) \
+                .filter(Q(last_read__isnull=True) | Q(last_read__lt=self.id)) \
+                .exclude(user_id=self.user_id) \
+                .update(unread_count=F('unread_count') - 1)
+
+            super().delete(using, keep_parents)
+
+            Chat.update_summary(self.chat_id, -1)
+
+
+def count_unread_messages(last_read):
+    """
+    number of messages newer than `last_read` written by others, as an expression for ChatUser updates
+    """
+    messages = Message.objects.filter(chat_id=OuterRef('chat_id'), id__gt=last_read) \
+        .exclude(user_id=OuterRef('user_id')).order_by().values('chat_id').annotate(count=Count('id'))
+
+    return Coalesce(Subquery(messages.values('count')), 0)
 
 
 class ChatUser(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     chat = models.ForeignKey(Chat, on_delete=models.CASCADE)
     last_read = models.IntegerField(null=True)
-
-    def change_last_read(self, last_message_id):
-        if not self.last_read:
-            self.last_read = self.chat.messages.last().id
-        elif last_message_id > self.last_read:
-            self.last_read = last_message_id
-        self.save()
-
-        return self.last_read
+    # messages of other members newer than last_read, maintained on write instead of counted on read
+    unread_count = models.PositiveIntegerField(default=0)
+    # when the chat last got a message, kept per member so the chat list of a user is read by index
+    last_activity = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', '-last_activity', '-chat'], name='chatuser_user_activity_idx'),
+        ]
+
+    @staticmethod
+    def record_new_messages(chat_id, sender_counts):
+        """
+        adds new messages of a chat to the unread counters and the activity of all members with one UPDATE,
+        `sender_counts` maps author ids to the number of their new messages
+        """
+        total = sum(sender_counts.values())
+        increment = Case(*[When(user_id=user_id, then=Value(total - count))
+                           for user_id, count in sender_counts.items()], default=Value(total))
+
+        ChatUser.objects.filter(chat_id=chat_id).update(unread_count=F('unread_count') + increment,
+                                                        last_activity=timezone.now())
+
+    @staticmethod
+    def advance_last_read(chat_id, user_id, message_id):
+        """
+        moves last_read forward to `message_id` with one conditional UPDATE, which writes nothing
+        when the position would not move. The unread counter is recounted in the same statement,
+        so messages which arrive meanwhile are not lost. Returns whether the position moved
+        """
+        return bool(ChatUser.objects.filter(chat_id=chat_id, user_id=user_id)
+                    .filter(Q(last_read__isnull=True) | Q(last_read__lt=message_id))
+                    .update(last_read=message_id, unread_count=count_unread_messages(message_id)))
+
+
+class ChatListVersion(models.Model):
+    """
+    single row counter of chat list versions. Incrementing it locks the row until the transaction commits,
+    so versions become visible in the order they are assigned and a client never skips a late commit
+    """
+    value = models.BigIntegerField(default=0)
+
+    @staticmethod
+    def next_value():
+        if not ChatListVersion.objects.filter(pk=1).update(value=F('value') + 1):
+            ChatListVersion.objects.get_or_create(pk=1)
+            ChatListVersion.objects.filter(pk=1).update(value=F('value') + 1)
+
+        return ChatListVersion.objects.values_list('value', flat=True).get(pk=1)
+
+
+class RemovedChat(models.Model):
+    """
+    chat which a user left or which was deleted, reported to chat list deltas newer than `version`
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    # not a foreign key, the record outlives a deleted chat
+    chat_id = models.IntegerField()
+    version = models.BigIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'chat_id'], name='unique_removed_chat'),
+        ]
+        indexes = [
+            models.Index(fields=['user', 'version'], name='removed_chat_user_version_idx'),
+        ]
+
+
+class ChatListChanges:
+    """
+    chats and memberships changed by one transaction, they get one new version once it commits
+    """
+    def __init__(self):
+        self.chat_ids = set()
+        # (chat id, user id) of users who joined or left
+        self.members = set()
+        self.assigned = False
+
+    def assign_versions(self):
+        """
+        memberships are checked against the database, so a join and a leave within one transaction
+        leave the RemovedChat record of the final state
+        """
+        self.assigned = True
+
+        try:
+            with transaction.atomic():
+                version = ChatListVersion.next_value()
+                Chat.objects.filter(pk__in=self.chat_ids).update(version=version)
+
+                if self.members:
+                    query = Q()
+                    for chat_id, user_id in self.members:
+                        query |= Q(chat_id=chat_id, user_id=user_id)
+
+                    current_members = set(ChatUser.objects.filter(query).values_list('chat_id', 'user_id'))
+                    RemovedChat.objects.filter(query).delete()
+                    RemovedChat.objects.bulk_create([
+                        RemovedChat(chat_id=chat_id, user_id=user_id, version=version)
+                        for chat_id, user_id in self.members - current_members])
+        except DatabaseError:
+            # the change itself is committed, the chats show up in full lists and with their next change
+            logger.exception('Could not assign chat list versions to chats %s', sorted(self.chat_ids))
+
+
+class FileQuerySet(models.QuerySet):
+    def bulk_create(self, objs, *args, **kwargs):
+        with transaction.atomic(using=self.db):
+            objs = super().bulk_create(objs, *args, **kwargs)
+
+            count_changes = {}
+            for file in objs:
+                chat_counts = count_changes.setdefault(file.chat_id, {})
+                chat_counts[file.file_type] = chat_counts.get(file.file_type, 0) + 1
+
+            for chat_id, chat_counts in count_changes.items():
+                Chat.update_file_counts(chat_id, chat_counts)
+
+            return objs
 
 
 def get_file_path(self, filename):
@@ -194,17 +463,74 @@ class File(models.Model):
     file = models.FileField(upload_to=get_file_path, max_length=255)
     chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='files')
     message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='files', null=True)
+    # downscaled JPEG copies of images stored next to the original, so galleries and chats do not load originals
+    thumbnail = models.ImageField(upload_to=get_file_path, max_length=255, null=True, blank=True, default=None)
+    preview = models.ImageField(upload_to=get_file_path, max_length=255, null=True, blank=True, default=None)
+
+    # Chat fields which count files of every type
+    COUNT_FIELDS = {
+        IMAGE: 'image_count',
+        DOCUMENT: 'document_count',
+    }
 
     file_type = models.CharField(max_length=3, choices=FILE_TYPES, default=DOCUMENT)
 
+    objects = FileQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # gallery pages of one file type in a chat, ordered by id
+            models.Index(fields=['chat', 'file_type', 'id'], name='file_chat_type_id_idx'),
+        ]
+
     def save(self, *args, **kwargs):
         if 'image' in self.file.file.content_type:
             self.file_type = self.IMAGE
 
         self.file_name = '_'.join(os.path.basename(self.file.name).split())
         self.file_size = self.file.size
-        super().save()
+
+        with transaction.atomic():
+            adding = self._state.adding
+            super().save()
+
+            if adding:
+                Chat.update_file_counts(self.chat_id, {self.file_type: 1})
+
+            # previews are rendered after the upload is committed and answered
+            if adding and self.file_type == self.IMAGE:
+                transaction.on_commit(self.generate_previews)
+
+    def generate_previews(self):
+        self.file.seek(0)
+        data = self.file.read()
+        self.file.seek(0)
+
+        generate_previews(data, partial(File.store_previews, self.pk))
+
+    @classmethod
+    def store_previews(cls, pk, previews):
+        file = cls.objects.select_related('chat').filter(pk=pk).first()
+        if not previews or not file:
+            return
+
+        name = os.path.splitext(file.file_name)[0]
+        thumbnail, preview = previews
+        file.thumbnail.save(f'{name}_thumbnail.jpeg', ContentFile(thumbnail), save=False)
+        file.preview.save(f'{name}_preview.jpeg', ContentFile(preview), save=False)
+
+        # the file may be deleted while its previews are rendered
+        if not cls.objects.filter(pk=pk).update(thumbnail=file.thumbnail.name, preview=file.preview.name):
+            for field in [file.thumbnail, file.preview]:
+                file_cleaner.delete_assigned_file(field)
+
+    def delete_stored_files(self):
+        for field in [self.file, self.thumbnail, self.preview]:
+            file_cleaner.delete_assigned_file(field)
 
     def delete(self, using=None, keep_parents=False):
-        file_cleaner.delete_assigned_file(self.file)
-        return super().delete(using, keep_parents)
+        self.delete_stored_files()
+
+        with transaction.atomic():
+            Chat.update_file_counts(self.chat_id, {self.file_type: -1})
+            return super().delete(using, keep_parents)
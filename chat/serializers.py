@@ -1,16 +1,21 @@
 from rest_framework import serializers
 from .models import Chat, Message, File
-from users.models import User
 from wiki.models import Article
 
 
 class FileSerializer(serializers.ModelSerializer):
     class Meta:
         model = File
-        fields = ['id', 'file', 'file_name', 'file_size', 'file_type', 'chat']
+        fields = ['id', 'file', 'file_name', 'file_size', 'file_type', 'thumbnail', 'preview', 'chat']
         extra_kwargs = {
             'chat': {
                 'write_only': True
+            },
+            'thumbnail': {
+                'read_only': True
+            },
+            'preview': {
+                'read_only': True
             }
         }
 
@@ -21,33 +26,36 @@ class ArticleSerializer(serializers.ModelSerializer):
         fields = ['id', 'title']
 
 
-class UserMessageSerializer(serializers.ModelSerializer):
-    class Meta:
-        model = User
-        fields = ['id', 'first_name', 'last_name', 'avatar']
-
-
 class MessageSerializer(serializers.ModelSerializer):
     files = FileSerializer(many=True, read_only=True)
     articles = ArticleSerializer(many=True, read_only=True)
+    user = serializers.SerializerMethodField()
 
-    def to_representation(self, instance):
-        representation = super().to_representation(instance)
+    def get_user(self, instance):
+        # built directly instead of with a nested serializer, which was instantiated for every message
+        user = instance.user
 
-        representation['user'] = UserMessageSerializer(instance=instance.user).data
-
-        return representation
+        return {
+            'id': user.id,
+            'first_name': user.first_name,
+            'last_name': user.last_name,
+            'avatar': user.avatar.url if user.avatar else None
+        }
 
     class Meta:
         model = Message
-        fields = ['id', 'chat_id', 'files', 'articles', 'text', 'date']
+        fields = ['id', 'chat_id', 'seq', 'files', 'articles', 'text', 'date', 'user']
 
 
 class ChatSerializer(serializers.ModelSerializer):
+    # annotated from the ChatUser row of the requesting user
+    last_activity = serializers.DateTimeField(read_only=True)
+
     def to_representation(self, instance):
         representation = super().to_representation(instance)
 
-        last_message = instance.messages.select_related('user').last()
+        # the summary is expected to be loaded with select_related('last_message__user')
+        last_message = instance.last_message
         if last_message:
             representation['last_message'] = {
                 'id': last_message.id,
@@ -64,4 +72,4 @@ class ChatSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Chat
-        fields = ['id', 'title', 'cover']
+        fields = ['id', 'title', 'cover', 'message_count', 'last_activity', 'version']
@@ -0,0 +1,66 @@
+import asyncio
+import logging
+import threading
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import Chat, ChatUser
+from .consumers import get_user_group_name
+
+
+logger = logging.getLogger(__name__)
+
+# users whose memberships changed in the current thread's transaction, notified once it commits
+pending = threading.local()
+
+
+def get_pending_user_ids():
+    if not hasattr(pending, 'user_ids'):
+        pending.user_ids = set()
+
+    return pending.user_ids
+
+
+async def send_membership_changed(user_ids):
+    channel_layer = get_channel_layer()
+    await asyncio.gather(*[channel_layer.group_send(get_user_group_name(user_id), {'type': 'chat_membership_changed'})
+                           for user_id in user_ids])
+
+
+def notify_membership_changed():
+    """
+    tells every open socket of the changed users to refresh the cached list of chats. Changes of one
+    transaction are sent together, so syncing a large chat is one batch instead of a round trip per member
+    """
+    user_ids = set(get_pending_user_ids())
+    get_pending_user_ids().clear()
+    if not user_ids:
+        return
+
+    try:
+        async_to_sync(send_membership_changed)(user_ids)
+    except Exception:
+        # the membership is already committed, sockets pick it up on reconnect
+        logger.exception('Could not notify %d users about chat membership changes', len(user_ids))
+
+
+def schedule_notification(user_id):
+    # ids left by a rolled back transaction go out with the next batch, an extra refresh is harmless
+    get_pending_user_ids().add(user_id)
+    # the first callback to run sends the whole batch, later ones find it empty
+    transaction.on_commit(notify_membership_changed)
+
+
+@receiver(post_save, sender=ChatUser)
+def chat_user_created(sender, instance, created, **kwargs):
+    if created:
+        schedule_notification(instance.user_id)
+        Chat.mark_changed(instance.chat_id, instance.user_id)
+
+
+@receiver(post_delete, sender=ChatUser)
+def chat_user_deleted(sender, instance, **kwargs):
+    schedule_notification(instance.user_id)
+    Chat.mark_changed(instance.chat_id, instance.user_id)
@@ -0,0 +1,576 @@
+import asyncio
+import json
+import os
+import shutil
+from datetime import timedelta
+import msgpack
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from unittest.mock import AsyncMock, patch
+from django.conf import settings
+from django.db import DatabaseError
+from django.test import SimpleTestCase, override_settings
+from rest_framework.test import APITransactionTestCase
+from rest_framework_simplejwt.tokens import AccessToken
+from config.middlewares import TokenAuthMiddleware
+from users.tests.mixins import TestUserAuthenticationMixin
+from users.tests.utils.user_creator import create_user, SECOND_USER_DATA
+from chat.consumers import ChatConsumer, create_message, read_position_buffer, read_positions, save_read_positions, \
+    sent_messages, typing_users, user_rate_limit_buckets
+from chat.utils import metrics
+from chat.utils.presence import get_presence
+from chat.routing import websocket_urlpatterns
+from chat.models import Chat, ChatUser, Message
+
+
+TEST_CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+    },
+}
+
+
+@override_settings(CHANNEL_LAYERS=TEST_CHANNEL_LAYERS)
+class ChatConsumerTestCase(TestUserAuthenticationMixin, APITransactionTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.chat = Chat.objects.create(title='TestChat', create_cover=False)
+        self.other_chat = Chat.objects.create(title='OtherChat', create_cover=False)
+        ChatUser.objects.create(chat=self.chat, user=self.user)
+
+        sent_messages.clear()
+        user_rate_limit_buckets.clear()
+        typing_users.clear()
+        read_positions.clear()
+
+    async def connect(self, token=None, subprotocols=None):
+        application = TokenAuthMiddleware(URLRouter(websocket_urlpatterns))
+        communicator = WebsocketCommunicator(application, f'/ws/chat/?access={token or self.token}',
+                                             subprotocols=subprotocols)
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertEqual(subprotocol, subprotocols[0] if subprotocols else None)
+
+        return communicator
+
+    async def test_new_message(self):
+        communicator = await self.connect()
+
+        await communicator.send_json_to({'message': {
+            'message_type': 'new_message', 'chat_id': self.chat.id, 'text': 'hello', 'client_side_id': 1
+        }})
+        response = await communicator.receive_json_from()
+
+        self.assertEqual(response['status'], 'success')
+        self.assertEqual(response['message']['text'], 'hello')
+        self.assertEqual(response['message']['client_side_id'], 1)
+        self.assertEqual(response['message']['seq'], 1)
+        self.assertTrue(await database_sync_to_async(Message.objects.filter(text='hello').exists)())
+
+        await communicator.disconnect()
+
+    async def test_retried_message(self):
+        communicator = await self.connect()
+        other_communicator = await self.connect()
+        payload = {'message': {
+            'message_type': 'new_message', 'chat_id': self.chat.id, 'text': 'hello', 'client_side_id': 'abc'
+        }}
+
+        await communicator.send_json_to(payload)
+        original = await communicator.receive_json_from()
+        await other_communicator.receive_json_from()
+
+        await communicator.send_json_to(payload)
+        response = await communicator.receive_json_from()
+
+        self.assertTrue(response['message']['duplicate'])
+        self.assertEqual(response['message']['id'], original['message']['id'])
+
+        # the unique constraint catches retries that another worker's cache has not seen
+        sent_messages.clear()
+        await communicator.send_json_to(payload)
+        response = await communicator.receive_json_from()
+
+        self.assertTrue(response['message']['duplicate'])
+        self.assertEqual(response['message']['id'], original['message']['id'])
+
+        # retries are never broadcast
+        self.assertTrue(await other_communicator.receive_nothing())
+        self.assertEqual(await database_sync_to_async(Message.objects.count)(), 1)
+
+        await communicator.disconnect()
+        await other_communicator.disconnect()
+
+    async def test_reused_client_side_id(self):
+        await database_sync_to_async(ChatUser.objects.create)(chat=self.other_chat, user=self.user)
+        communicator = await self.connect()
+
+        # ids are deduplicated per chat
+        for chat in [self.chat, self.other_chat]:
+            await communicator.send_json_to({'message': {
+                'message_type': 'new_message', 'chat_id': chat.id, 'text': 'hello', 'client_side_id': 'abc'
+            }})
+            response = await communicator.receive_json_from()
+
+            self.assertNotIn('duplicate', response['message'])
+
+        # and only within CHAT_DEDUPE_TTL seconds, a later send with the same id is a new message
+        sent_messages.clear()
+        with override_settings(CHAT_DEDUPE_TTL=0):
+            await communicator.send_json_to({'message': {
+                'message_type': 'new_message', 'chat_id': self.chat.id, 'text': 'again', 'client_side_id': 'abc'
+            }})
+            response = await communicator.receive_json_from()
+
+        self.assertNotIn('duplicate', response['message'])
+        self.assertEqual(response['message']['text'], 'again')
+        self.assertEqual(await database_sync_to_async(Message.objects.count)(), 3)
+
+        await communicator.disconnect()
+
+    @override_settings(CHAT_SYNC_MAX_MESSAGES=3)
+    async def test_sync(self):
+        await database_sync_to_async(ChatUser.objects.create)(chat=self.other_chat, user=self.user)
+        messages = []
+        for i in range(3):
+            for chat in [self.chat, self.other_chat]:
+                messages.append(await database_sync_to_async(Message.objects.create)(
+                    user=self.user, chat=chat, text=f'{chat.id} {i}'))
+
+        communicator = await self.connect()
+
+        await communicator.send_json_to({'message': {'message_type': 'sync', 'chats': {
+            self.chat.id: messages[0].id, self.other_chat.id: None
+        }}})
+        response = await communicator.receive_json_from()
+
+        self.assertTrue(response['message']['has_more'])
+        self.assertEqual([message['id'] for message in response['message']['messages']],
+                         [messages[1].id, messages[2].id, messages[3].id])
+
+        await communicator.send_json_to({'message': {'message_type': 'sync', 'chats': {
+            self.chat.id: messages[4].id, self.other_chat.id: messages[3].id
+        }}})
+        response = await communicator.receive_json_from()
+
+        self.assertFalse(response['message']['has_more'])
+        self.assertEqual([message['id'] for message in response['message']['messages']], [messages[5].id])
+
+        await communicator.disconnect()
+
+    @override_settings(CHAT_RATE_LIMITS={'new_message': (0.001, 2)})
+    async def test_rate_limit(self):
+        communicator = await self.connect()
+
+        for i in range(3):
+            await communicator.send_json_to({'message': {
+                'message_type': 'new_message', 'chat_id': self.chat.id, 'text': 'hello'
+            }})
+            response = await communicator.receive_json_from()
+
+        self.assertEqual(response['status'], 'error')
+        self.assertEqual(response['message']['message_type'], 'new_message')
+        self.assertGreater(response['message']['retry_after'], 0)
+        self.assertEqual(await database_sync_to_async(Message.objects.count)(), 2)
+
+        await communicator.disconnect()
+
+    async def test_msgpack_subprotocol(self):
+        communicator = await self.connect(subprotocols=['ggaek.msgpack.v1'])
+        json_communicator = await self.connect()
+
+        await communicator.send_to(bytes_data=msgpack.packb({'message': {
+            'message_type': 'new_message', 'chat_id': self.chat.id, 'text': 'hello'
+        }}))
+        response = msgpack.unpackb(await communicator.receive_from())
+
+        self.assertEqual(response['status'], 'success')
+        self.assertEqual(response['message']['text'], 'hello')
+
+        # sockets without the subprotocol still receive JSON
+        response = await json_communicator.receive_json_from()
+
+        self.assertEqual(response['message']['text'], 'hello')
+
+        # chat ids are natural integer map keys in MessagePack
+        await communicator.send_to(bytes_data=msgpack.packb({'message': {
+            'message_type': 'sync', 'chats': {self.chat.id: 0}
+        }}))
+        response = msgpack.unpackb(await communicator.receive_from(), strict_map_key=False)
+
+        self.assertEqual(response['status'], 'success')
+        self.assertEqual(len(response['message']['messages']), 1)
+
+        # a map with an array key, which cannot be unpacked into a dict
+        await communicator.send_to(bytes_data=b'\x81\x91\x01\x01')
+        response = msgpack.unpackb(await communicator.receive_from())
+
+        self.assertEqual(response, {'status': 'error', 'message': {'message': 'Wrong message format'}})
+
+        await communicator.disconnect()
+        await json_communicator.disconnect()
+
+    @override_settings(CHAT_MSGPACK=False)
+    async def test_msgpack_disabled(self):
+        communicator = WebsocketCommunicator(TokenAuthMiddleware(URLRouter(websocket_urlpatterns)),
+                                             f'/ws/chat/?access={self.token}', subprotocols=['ggaek.msgpack.v1'])
+        connected, subprotocol = await communicator.connect()
+
+        self.assertTrue(connected)
+        self.assertIsNone(subprotocol)
+        self.assertNotIn('bytes', ChatConsumer.build_event('success_message', {}))
+
+        await communicator.disconnect()
+
+    async def test_groups_left_on_disconnect(self):
+        communicator = await self.connect()
+        channel_layer = get_channel_layer()
+
+        self.assertEqual(len(channel_layer.groups[str(self.chat.id)]), 1)
+        self.assertEqual(len(channel_layer.groups[f'user_{self.user.id}']), 1)
+
+        await communicator.disconnect()
+
+        self.assertFalse(channel_layer.groups.get(str(self.chat.id)))
+        self.assertFalse(channel_layer.groups.get(f'user_{self.user.id}'))
+
+    @override_settings(CHAT_PING_INTERVAL=0.2, CHAT_IDLE_TIMEOUT=0.5)
+    async def test_idle_connection_reaped(self):
+        reaped = metrics.counters['chat_reaped_connections']
+        communicator = await self.connect()
+
+        await communicator.send_json_to({'message': {'message_type': 'ping'}})
+        response = await communicator.receive_json_from()
+
+        self.assertEqual(response['message'], {'message_type': 'pong'})
+
+        response = await communicator.receive_json_from(timeout=1)
+
+        self.assertEqual(response['message']['message_type'], 'ping')
+
+        response = await communicator.receive_output(timeout=1)
+
+        self.assertEqual(response['type'], 'websocket.close')
+        self.assertEqual(response['code'], ChatConsumer.IDLE_CLOSE_CODE)
+        self.assertEqual(metrics.counters['chat_reaped_connections'], reaped + 1)
+
+    async def test_presence(self):
+        communicator = await self.connect()
+        self.assertEqual(await get_presence().get_online([self.user.id]), {self.user.id})
+
+        await communicator.disconnect()
+        self.assertEqual(await get_presence().get_online([self.user.id]), set())
+
+    @override_settings(CHAT_LAZY_SUBSCRIPTIONS=True)
+    async def test_lazy_subscriptions(self):
+        second_user = await database_sync_to_async(create_user)(SECOND_USER_DATA)
+        self.addCleanup(shutil.rmtree, os.path.join(settings.MEDIA_ROOT, SECOND_USER_DATA['email']))
+        await database_sync_to_async(ChatUser.objects.create)(chat=self.chat, user=second_user)
+
+        communicator = await self.connect()
+        own_communicator = await self.connect()
+        other_communicator = await self.connect(AccessToken.for_user(second_user))
+
+        await communicator.send_json_to({'message': {'message_type': 'subscribe', 'chat_ids': [self.chat.id]}})
+        response = await communicator.receive_json_from()
+
+        self.assertEqual(response['message'], {'message_type': 'subscribe', 'chat_ids': [self.chat.id]})
+
+        await communicator.send_json_to({'message': {
+            'message_type': 'new_message', 'chat_id': self.chat.id, 'text': 'hello'
+        }})
+        response = await communicator.receive_json_from()
+
+        self.assertEqual(response['message']['text'], 'hello')
+        self.assertTrue(await communicator.receive_nothing())
+
+        # not subscribed socket gets only the unread badge
+        response = await other_communicator.receive_json_from()
+
+        self.assertEqual(response['message']['message_type'], 'chat_activity')
+        self.assertEqual(response['message']['chat_id'], self.chat.id)
+        # own messages are not unread for the sender's other sockets
+        self.assertTrue(await own_communicator.receive_nothing())
+
+        await communicator.send_json_to({'message': {'message_type': 'subscribe', 'chat_ids': [self.other_chat.id]}})
+        response = await communicator.receive_json_from()
+
+        self.assertEqual(response['status'], 'error')
+
+        await communicator.disconnect()
+        await own_communicator.disconnect()
+        await other_communicator.disconnect()
+
+    @override_settings(CHAT_WRITE_BEHIND=True)
+    async def test_write_behind(self):
+        communicators = [await self.connect() for _ in range(3)]
+
+        await asyncio.gather(*[communicator.send_json_to({'message': {
+            'message_type': 'new_message', 'chat_id': self.chat.id, 'text': f'hello {i}', 'client_side_id': i
+        }}) for i, communicator in enumerate(communicators)])
+
+        for communicator in communicators:
+            responses = [await communicator.receive_json_from() for _ in communicators]
+            # every client_side_id still maps to its own message
+            for response in responses:
+                self.assertEqual(response['message']['text'], f'hello {response["message"]["client_side_id"]}')
+
+            await communicator.disconnect()
+
+        self.assertEqual(await database_sync_to_async(Message.objects.count)(), 3)
+
+    @override_settings(CHAT_WRITE_BEHIND=True)
+    async def test_write_behind_failure(self):
+        communicators = [await self.connect() for _ in range(2)]
+
+        def fail_bad_text(data, user):
+            if data['text'] == 'bad':
+                raise DatabaseError
+            return create_message(data, user)
+
+        # the batch fails as a whole, then only the failing entry fails
+        with patch('chat.consumers.bulk_create_messages', side_effect=DatabaseError), \
+                patch('chat.consumers.create_message', side_effect=fail_bad_text), \
+                self.assertLogs('chat.consumers', 'ERROR'):
+            await asyncio.gather(*[communicator.send_json_to({'message': {
+                'message_type': 'new_message', 'chat_id': self.chat.id, 'text': text
+            }}) for text, communicator in zip(['hello', 'bad'], communicators)])
+
+            responses = [await communicators[1].receive_json_from() for _ in range(2)]
+
+        # the other sender's message is saved and broadcast
+        self.assertIn({'status': 'error', 'message': {'message': 'Message could not be saved'}}, responses)
+        self.assertIn('hello', [response['message'].get('text') for response in responses])
+        self.assertEqual((await communicators[0].receive_json_from())['message']['text'], 'hello')
+        self.assertEqual(await database_sync_to_async(Message.objects.count)(), 1)
+
+        for communicator in communicators:
+            await communicator.disconnect()
+
+    async def test_typing(self):
+        second_user = await database_sync_to_async(create_user)(SECOND_USER_DATA)
+        self.addCleanup(shutil.rmtree, os.path.join(settings.MEDIA_ROOT, SECOND_USER_DATA['email']))
+        await database_sync_to_async(ChatUser.objects.create)(chat=self.chat, user=second_user)
+
+        communicator = await self.connect()
+        other_communicator = await self.connect(AccessToken.for_user(second_user))
+
+        for _ in range(3):
+            await communicator.send_json_to({'message': {'message_type': 'typing', 'chat_id': self.chat.id}})
+        response = await other_communicator.receive_json_from()
+
+        self.assertEqual(response['message']['message_type'], 'typing')
+        self.assertEqual(response['message']['user_id'], self.user.id)
+        # repeated events are coalesced and the typing user gets no echo
+        self.assertTrue(await other_communicator.receive_nothing())
+        self.assertTrue(await communicator.receive_nothing())
+        self.assertFalse(await database_sync_to_async(Message.objects.exists)())
+
+        await communicator.disconnect()
+        await other_communicator.disconnect()
+
+    @patch.object(read_position_buffer, 'delay', 0.05)
+    async def test_read(self):
+        messages = [await database_sync_to_async(Message.objects.create)(user=self.user, chat=self.chat)
+                    for _ in range(2)]
+        communicator = await self.connect()
+
+        for message in [messages[0], messages[1], messages[0]]:
+            await communicator.send_json_to({'message': {
+                'message_type': 'read', 'chat_id': self.chat.id, 'message_id': message.id
+            }})
+        # receipts are not answered
+        self.assertTrue(await communicator.receive_nothing(timeout=0.2))
+
+        chat_user = await database_sync_to_async(ChatUser.objects.get)(chat=self.chat, user=self.user)
+        self.assertEqual(chat_user.last_read, messages[1].id)
+
+        await communicator.disconnect()
+
+    @patch.object(read_position_buffer, 'delay', 0.05)
+    async def test_read_invalid_position(self):
+        message = await database_sync_to_async(Message.objects.create)(user=self.user, chat=self.chat)
+        communicator = await self.connect()
+
+        await communicator.send_json_to({'message': {
+            'message_type': 'read', 'chat_id': self.chat.id, 'message_id': 2 ** 31
+        }})
+        response = await communicator.receive_json_from()
+
+        self.assertEqual(response['status'], 'error')
+        self.assertIn('message_id', response['message'])
+
+        # positions past the last message of the chat are capped
+        await communicator.send_json_to({'message': {
+            'message_type': 'read', 'chat_id': self.chat.id, 'message_id': message.id + 100
+        }})
+        self.assertTrue(await communicator.receive_nothing(timeout=0.2))
+
+        chat_user = await database_sync_to_async(ChatUser.objects.get)(chat=self.chat, user=self.user)
+        self.assertEqual(chat_user.last_read, message.id)
+        self.assertEqual(read_positions.get((self.chat.id, self.user.id)), message.id)
+
+        await communicator.disconnect()
+
+    async def test_read_position_failure(self):
+        await database_sync_to_async(ChatUser.objects.create)(chat=self.other_chat, user=self.user)
+        messages = [await database_sync_to_async(Message.objects.create)(user=self.user, chat=chat)
+                    for chat in [self.chat, self.other_chat]]
+        advance_last_read = ChatUser.advance_last_read
+
+        def fail_first_chat(chat_id, user_id, message_id):
+            if chat_id == self.chat.id:
+                raise DatabaseError
+            return advance_last_read(chat_id, user_id, message_id)
+
+        # a failing position is logged and does not roll back the others
+        with patch.object(ChatUser, 'advance_last_read', side_effect=fail_first_chat), \
+                self.assertLogs('chat.consumers', 'ERROR'):
+            await save_read_positions({(message.chat_id, self.user.id): message.id for message in messages})
+
+        chat_user = await database_sync_to_async(ChatUser.objects.get)(chat=self.other_chat, user=self.user)
+        self.assertEqual(chat_user.last_read, messages[1].id)
+        # the failed position is not cached, so the client can send it again
+        self.assertIsNone(read_positions.get((self.chat.id, self.user.id)))
+        self.assertEqual(read_positions.get((self.other_chat.id, self.user.id)), messages[1].id)
+
+    async def test_not_chat_member(self):
+        communicator = await self.connect()
+
+        await communicator.send_json_to({'message': {
+            'message_type': 'new_message', 'chat_id': self.other_chat.id, 'text': 'hello'
+        }})
+        response = await communicator.receive_json_from()
+
+        self.assertEqual(response['status'], 'error')
+        self.assertIn('chat_id', response['message'])
+
+        await communicator.disconnect()
+
+    async def test_membership_change(self):
+        communicator = await self.connect()
+
+        await database_sync_to_async(ChatUser.objects.create)(chat=self.other_chat, user=self.user)
+        # lets the consumer handle the membership event before the next frame
+        self.assertTrue(await communicator.receive_nothing())
+
+        await communicator.send_json_to({'message': {
+            'message_type': 'new_message', 'chat_id': self.other_chat.id, 'text': 'hello'
+        }})
+        response = await communicator.receive_json_from()
+
+        self.assertEqual(response['status'], 'success')
+        self.assertEqual(response['message']['chat_id'], self.other_chat.id)
+
+        await communicator.disconnect()
+
+    async def test_refresh_token(self):
+        communicator = await self.connect()
+        token = AccessToken.for_user(self.user)
+
+        await communicator.send_json_to({'message': {'message_type': 'refresh_token', 'access': str(token)}})
+        response = await communicator.receive_json_from()
+
+        self.assertEqual(response['status'], 'success')
+        self.assertEqual(response['message']['exp'], token['exp'])
+
+        await communicator.send_json_to({'message': {'message_type': 'refresh_token', 'access': 'wrong'}})
+        response = await communicator.receive_json_from()
+
+        self.assertEqual(response['status'], 'error')
+
+        await communicator.disconnect()
+
+    async def test_token_expiry(self):
+        token = AccessToken.for_user(self.user)
+        token.set_exp(lifetime=timedelta(seconds=1))
+
+        communicator = await self.connect(token)
+
+        response = await communicator.receive_output(timeout=3)
+
+        self.assertEqual(response['type'], 'websocket.close')
+        self.assertEqual(response['code'], 4001)
+
+
+@override_settings(CHAT_OUTBOUND_WINDOW=4, CHAT_OUTBOUND_ACK_INTERVAL=2, CHAT_MSGPACK=False)
+class ChatConsumerFlowControlTestCase(SimpleTestCase):
+    def create_consumer(self):
+        consumer = ChatConsumer()
+        consumer.send = AsyncMock()
+        consumer.close = AsyncMock()
+
+        return consumer
+
+    async def broadcast(self, consumer, count):
+        for i in range(count):
+            await consumer.success_message({'text': str(i)})
+
+    def get_sent(self, consumer):
+        return [call.kwargs['text_data'] for call in consumer.send.await_args_list]
+
+    async def turn_on_flow_control(self, consumer):
+        await self.broadcast(consumer, 2)
+        await consumer.pong({'message_type': 'pong', 'frame': consumer.last_ping_frame})
+        consumer.send.reset_mock()
+
+    async def test_pings_sent(self):
+        consumer = self.create_consumer()
+
+        await self.broadcast(consumer, 2)
+
+        # every second frame is followed by a ping numbering the frames it acknowledges
+        self.assertEqual(self.get_sent(consumer)[2], json.dumps(
+            {'status': 'success', 'message': {'message_type': 'ping', 'frame': 3}}))
+
+        await consumer.pong({'message_type': 'pong', 'frame': 3})
+
+        self.assertTrue(consumer.flow_control)
+        self.assertEqual(consumer.get_unacked_frames(), 0)
+
+    async def test_no_flow_control(self):
+        consumer = self.create_consumer()
+
+        # clients which do not echo ping frames get every broadcast
+        await consumer.pong({'message_type': 'pong'})
+        await self.broadcast(consumer, 10)
+
+        self.assertFalse(consumer.flow_control)
+        self.assertEqual([frame for frame in self.get_sent(consumer) if 'ping' not in frame],
+                         [str(i) for i in range(10)])
+
+    @override_settings(CHAT_OUTBOUND_OVERFLOW_POLICY='resync')
+    async def test_window_resync(self):
+        consumer = self.create_consumer()
+        await self.turn_on_flow_control(consumer)
+        dropped = metrics.counters['chat_outbound_frames_dropped']
+
+        await self.broadcast(consumer, 6)
+
+        # 2 frames, a ping, 1 frame, then the window is full and the client is told to resync
+        sent = self.get_sent(consumer)
+        self.assertEqual(sent[:2], ['0', '1'])
+        self.assertIn('resync', sent[4])
+        self.assertEqual(len(sent), 6)
+        self.assertEqual(metrics.counters['chat_outbound_frames_dropped'], dropped + 3)
+
+        # broadcasts are dropped until the last ping is answered
+        await consumer.pong({'message_type': 'pong', 'frame': 6})
+        await self.broadcast(consumer, 1)
+        self.assertEqual(len(self.get_sent(consumer)), 6)
+
+        await consumer.pong({'message_type': 'pong', 'frame': 9})
+        await self.broadcast(consumer, 1)
+        self.assertEqual(self.get_sent(consumer)[-1], '0')
+
+    @override_settings(CHAT_OUTBOUND_OVERFLOW_POLICY='close')
+    async def test_window_close(self):
+        consumer = self.create_consumer()
+        await self.turn_on_flow_control(consumer)
+
+        await self.broadcast(consumer, 4)
+
+        consumer.close.assert_awaited_once_with(code=ChatConsumer.SLOW_CONSUMER_CLOSE_CODE)
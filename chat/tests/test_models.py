@@ -0,0 +1,202 @@
+import os
+import shutil
+from io import BytesIO
+from unittest.mock import patch
+from PIL import Image
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from users.tests.utils.user_creator import create_user, USER_DATA, SECOND_USER_DATA
+from chat.models import Chat, ChatUser, Message, File
+from chat.utils import thumbnails
+from chat.utils.thumbnails import generate_previews, render_previews
+
+
+class MessageAttachmentsTestCase(TestCase):
+    def setUp(self):
+        self.user = create_user()
+        self.chat = Chat.objects.create(title='TestChat', create_cover=False)
+        self.message = Message.objects.create(user=self.user, chat=self.chat, text='text')
+
+        File.objects.bulk_create([File(chat=self.chat, file=f'TestChat/{i}.txt') for i in range(10)])
+        self.file_ids = list(File.objects.values_list('id', flat=True))
+
+    def tearDown(self):
+        shutil.rmtree(os.path.join(settings.MEDIA_ROOT, USER_DATA['email']))
+
+    def test_add_files(self):
+        missing_id = max(self.file_ids) + 1
+
+        # one lookup and one update whatever the number of files
+        with self.assertNumQueries(2):
+            not_found_ids = self.message.add_files([str(pk) for pk in self.file_ids] + [str(missing_id)])
+
+        self.assertEqual(not_found_ids, [str(missing_id)])
+        self.assertEqual(set(self.message.files.values_list('id', flat=True)), set(self.file_ids))
+
+    def test_update_files(self):
+        self.message.add_files(self.file_ids[:5])
+        missing_id = max(self.file_ids) + 1
+
+        errors = self.message.update_files(self.file_ids[3:] + [missing_id])
+
+        self.assertEqual(errors, {'not_included_files': [missing_id]})
+        self.assertEqual(set(self.message.files.values_list('id', flat=True)), set(self.file_ids[3:]))
+        self.assertFalse(File.objects.filter(pk__in=self.file_ids[:3]).exists())
+
+
+class MessageSeqTestCase(TestCase):
+    def setUp(self):
+        self.user = create_user()
+        self.chat = Chat.objects.create(title='TestChat', create_cover=False)
+        self.other_chat = Chat.objects.create(title='OtherChat', create_cover=False)
+
+    def tearDown(self):
+        shutil.rmtree(os.path.join(settings.MEDIA_ROOT, USER_DATA['email']))
+
+    def test_dense_seqs(self):
+        Message.objects.create(user=self.user, chat=self.chat)
+        Message.objects.bulk_create([Message(user=self.user, chat=chat) for chat in [self.chat, self.other_chat] * 2])
+        Message.objects.create(user=self.user, chat=self.other_chat)
+
+        self.assertEqual(list(self.chat.messages.order_by('id').values_list('seq', flat=True)), [1, 2, 3])
+        self.assertEqual(list(self.other_chat.messages.order_by('id').values_list('seq', flat=True)), [1, 2, 3])
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.last_seq, 3)
+
+
+class ChatUserUnreadCountTestCase(TestCase):
+    def setUp(self):
+        self.user = create_user()
+        self.second_user = create_user(SECOND_USER_DATA)
+        self.chat = Chat.objects.create(title='TestChat', create_cover=False)
+        ChatUser.objects.bulk_create([ChatUser(chat=self.chat, user=user) for user in [self.user, self.second_user]])
+
+    def tearDown(self):
+        for data in [USER_DATA, SECOND_USER_DATA]:
+            shutil.rmtree(os.path.join(settings.MEDIA_ROOT, data['email']))
+
+    def get_unread_counts(self):
+        return dict(ChatUser.objects.values_list('user_id', 'unread_count'))
+
+    def test_counted_on_write(self):
+        Message.objects.create(user=self.user, chat=self.chat)
+        Message.objects.bulk_create([Message(user=user, chat=self.chat)
+                                     for user in [self.user, self.user, self.second_user]])
+
+        self.assertEqual(self.get_unread_counts(), {self.user.id: 1, self.second_user.id: 3})
+
+    def test_reset_on_read(self):
+        message = Message.objects.create(user=self.user, chat=self.chat)
+        self.assertTrue(ChatUser.advance_last_read(self.chat.id, self.second_user.id, message.id))
+
+        self.assertEqual(self.get_unread_counts()[self.second_user.id], 0)
+
+        messages = [Message.objects.create(user=self.user, chat=self.chat) for _ in range(3)]
+        self.assertEqual(self.get_unread_counts()[self.second_user.id], 3)
+
+        self.assertTrue(ChatUser.advance_last_read(self.chat.id, self.second_user.id, messages[0].id))
+        # moving backwards writes nothing
+        with self.assertNumQueries(1):
+            self.assertFalse(ChatUser.advance_last_read(self.chat.id, self.second_user.id, message.id))
+        self.assertEqual(self.get_unread_counts()[self.second_user.id], 2)
+
+        # only messages which are still unread are discounted
+        messages[0].delete()
+        messages[2].delete()
+        self.assertEqual(self.get_unread_counts()[self.second_user.id], 1)
+
+
+class ChatSummaryTestCase(TestCase):
+    def setUp(self):
+        self.user = create_user()
+        self.chat = Chat.objects.create(title='TestChat', create_cover=False)
+
+    def tearDown(self):
+        shutil.rmtree(os.path.join(settings.MEDIA_ROOT, USER_DATA['email']))
+
+    def assert_summary(self, last_message, message_count):
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.last_message_id, last_message.id if last_message else None)
+        self.assertEqual(self.chat.message_count, message_count)
+
+    def test_summary(self):
+        first_message = Message.objects.create(user=self.user, chat=self.chat)
+        self.assert_summary(first_message, 1)
+
+        Message.objects.bulk_create([Message(user=self.user, chat=self.chat) for _ in range(2)])
+        last_message = self.chat.messages.order_by('id').last()
+        self.assert_summary(last_message, 3)
+
+        last_message.delete()
+        self.assert_summary(self.chat.messages.order_by('id').last(), 2)
+
+        for message in self.chat.messages.all():
+            message.delete()
+        self.assert_summary(None, 0)
+
+
+@override_settings(CHAT_THUMBNAIL_WORKERS=0)
+class FilePreviewsTestCase(TestCase):
+    def setUp(self):
+        self.chat = Chat.objects.create(title='TestChat', create_cover=False)
+
+    def tearDown(self):
+        shutil.rmtree(os.path.join(settings.MEDIA_ROOT, 'TestChat'), ignore_errors=True)
+
+    def upload(self, name, content, content_type):
+        file = File(chat=self.chat, file=SimpleUploadedFile(name, content, content_type=content_type))
+        # previews are rendered after commit
+        with self.captureOnCommitCallbacks(execute=True):
+            file.save()
+        file.refresh_from_db()
+
+        return file
+
+    def test_image_previews(self):
+        picture = BytesIO()
+        Image.new('RGB', (2000, 1000), color='red').save(picture, format='JPEG')
+
+        file = self.upload('picture.jpg', picture.getvalue(), 'image/jpeg')
+
+        with Image.open(file.thumbnail.path) as thumbnail:
+            self.assertEqual(thumbnail.size, (settings.CHAT_THUMBNAIL_SIZE, settings.CHAT_THUMBNAIL_SIZE // 2))
+        with Image.open(file.preview.path) as preview:
+            self.assertEqual(preview.size, (settings.CHAT_PREVIEW_SIZE, settings.CHAT_PREVIEW_SIZE // 2))
+
+        paths = [file.file.path, file.thumbnail.path, file.preview.path]
+        file.delete()
+
+        self.assertFalse(any(os.path.exists(path) for path in paths))
+
+    def test_no_previews(self):
+        document = self.upload('document.txt', b'text', 'text/plain')
+        broken_image = self.upload('broken.jpg', b'not an image', 'image/jpeg')
+
+        for file in [document, broken_image]:
+            self.assertFalse(file.thumbnail)
+            self.assertFalse(file.preview)
+
+    def test_decompression_bomb(self):
+        picture = BytesIO()
+        Image.new('RGB', (2000, 1000), color='red').save(picture, format='PNG')
+
+        with patch.object(Image, 'MAX_IMAGE_PIXELS', 1000):
+            self.assertIsNone(render_previews(picture.getvalue(), [settings.CHAT_THUMBNAIL_SIZE]))
+
+    @override_settings(CHAT_THUMBNAIL_WORKERS=1)
+    def test_pool_previews(self):
+        picture = BytesIO()
+        Image.new('RGB', (2000, 1000), color='red').save(picture, format='JPEG')
+        results = []
+
+        with patch.object(thumbnails, 'executor', None):
+            future = generate_previews(picture.getvalue(), results.append)
+            self.addCleanup(thumbnails.executor.shutdown)
+            future.result(timeout=60)
+
+        thumbnail, preview = results[0]
+        with Image.open(BytesIO(thumbnail)) as image:
+            self.assertEqual(image.size, (settings.CHAT_THUMBNAIL_SIZE, settings.CHAT_THUMBNAIL_SIZE // 2))
+        with Image.open(BytesIO(preview)) as image:
+            self.assertEqual(image.size, (settings.CHAT_PREVIEW_SIZE, settings.CHAT_PREVIEW_SIZE // 2))
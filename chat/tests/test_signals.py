@@ -0,0 +1,34 @@
+import os
+import shutil
+from unittest.mock import AsyncMock, patch
+from django.conf import settings
+from django.db import transaction
+from django.test import TestCase
+from users.tests.utils.user_creator import create_user, USER_DATA, SECOND_USER_DATA
+from chat.models import Chat, ChatUser
+
+
+class MembershipNotificationTestCase(TestCase):
+    def setUp(self):
+        self.users = [create_user(), create_user(SECOND_USER_DATA)]
+        self.chat = Chat.objects.create(title='TestChat', create_cover=False)
+
+    def tearDown(self):
+        for data in [USER_DATA, SECOND_USER_DATA]:
+            shutil.rmtree(os.path.join(settings.MEDIA_ROOT, data['email']))
+
+    @patch('chat.signals.send_membership_changed', new_callable=AsyncMock)
+    def test_notifications_batched(self, send_membership_changed):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.chat.update_members(self.users)
+
+        send_membership_changed.assert_awaited_once_with({user.id for user in self.users})
+
+    @patch('chat.signals.send_membership_changed', new_callable=AsyncMock, side_effect=OSError)
+    def test_channel_layer_failure(self, send_membership_changed):
+        with self.assertLogs('chat.signals', level='ERROR'):
+            with self.captureOnCommitCallbacks(execute=True):
+                with transaction.atomic():
+                    ChatUser.objects.create(chat=self.chat, user=self.users[0])
+
+        self.assertTrue(ChatUser.objects.filter(chat=self.chat, user=self.users[0]).exists())
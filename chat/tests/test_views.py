@@ -3,20 +3,27 @@ import os
 from urllib import parse
 from django.urls import reverse
 from rest_framework import status
+from django.contrib.auth.models import Group
+from django.core.files.uploadedfile import SimpleUploadedFile
 from rest_framework.test import APITestCase
+from asgiref.sync import async_to_sync
 from users.tests.mixins import TestUserAuthenticationMixin
-from chat.models import Chat, ChatUser, Message
+from users.tests.utils.user_creator import create_user, SECOND_USER_DATA
+from chat.models import Chat, ChatUser, File, Message
 import io
 from django.conf import settings
 from shutil import rmtree
 from .utils.string_generator import generate_string
 from chat.serializers import MessageSerializer
+from chat.utils.presence import get_presence
 import mimetypes
+from unittest.mock import patch
+from users.models import User
+from chat.views import CursorChatUserPagination
 
 
 class ChatFilesTestCase(TestUserAuthenticationMixin, APITestCase):
-    test_file_folder = 'testfiles'
-    test_file_folder_path = os.path.join(settings.STATIC_ROOT, test_file_folder)
+    test_file_folder_path = os.path.join(os.path.dirname(__file__), 'files')
 
     test_chat_title = 'TestChat'
 
@@ -32,7 +39,7 @@ class ChatFilesTestCase(TestUserAuthenticationMixin, APITestCase):
         rmtree(os.path.join(settings.MEDIA_ROOT, self.test_chat_title))
 
     def send_file(self, filename):
-        file_path = os.path.join(settings.STATIC_ROOT, self.test_file_folder, filename)
+        file_path = os.path.join(self.test_file_folder_path, filename)
 
         with open(file_path) as file:
             send_file = io.FileIO(file.fileno())
@@ -43,7 +50,7 @@ class ChatFilesTestCase(TestUserAuthenticationMixin, APITestCase):
         return response
 
     def serialize_file(self, filename, pk):
-        file_path = os.path.join(settings.STATIC_ROOT, self.test_file_folder, filename)
+        file_path = os.path.join(self.test_file_folder_path, filename)
         file_size = os.stat(file_path).st_size
 
         file_type = 'IMG' if 'image' in mimetypes.guess_type(file_path)[0] else 'DOC'
@@ -55,7 +62,10 @@ class ChatFilesTestCase(TestUserAuthenticationMixin, APITestCase):
             'file': parse.quote(os.path.join(settings.MEDIA_URL, self.test_chat_title, filename)),
             'file_name': filename,
             'file_size': file_size,
-            'file_type': file_type
+            'file_type': file_type,
+            # previews of images are rendered after commit, the upload is answered without them
+            'thumbnail': None,
+            'preview': None
         }
 
         return file_data
@@ -131,3 +141,187 @@ class ChatMessagesTestCase(TestUserAuthenticationMixin, APITestCase):
                 break
 
             content = json.loads(self.client.get(content['next']).content)
+
+
+class ChatFilesQueriesTestCase(TestUserAuthenticationMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.chat = Chat.objects.create(title='TestChat', create_cover=False)
+        ChatUser.objects.create(chat=self.chat, user=self.user)
+
+    def tearDown(self):
+        super().tearDown()
+        rmtree(os.path.join(settings.MEDIA_ROOT, 'TestChat'))
+
+    def upload_files(self, count, content_type):
+        extension = 'jpg' if 'image' in content_type else 'txt'
+        for i in range(count):
+            file = File(chat=self.chat, file=SimpleUploadedFile(f'{i}.{extension}', b'x', content_type=content_type))
+            file.save()
+
+    def assert_first_page(self, counts):
+        # authentication, membership, files and counters
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('chat_files', kwargs={'chat_id': self.chat.id}), {'file_type': 'IMG'})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['counts'], counts)
+
+        return response.json()
+
+    def test_list_files(self):
+        self.upload_files(2, 'image/jpeg')
+        self.upload_files(1, 'text/plain')
+        self.assert_first_page({'IMG': 2, 'DOC': 1})
+
+        self.upload_files(40, 'image/jpeg')
+        content = self.assert_first_page({'IMG': 42, 'DOC': 1})
+
+        self.assertEqual(len(content['results']), 36)
+
+        File.objects.filter(file_type=File.DOCUMENT).first().delete()
+        self.assert_first_page({'IMG': 42, 'DOC': 0})
+
+        # next pages are served without the counters
+        response = self.client.get(reverse('chat_files', kwargs={'chat_id': self.chat.id}),
+                                   {'file_type': 'IMG', 'cursor': content['next']})
+        self.assertEqual(len(response.json()['results']), 6)
+        self.assertNotIn('counts', response.json())
+
+
+class ChatMessagesQueriesTestCase(TestUserAuthenticationMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.chat = Chat.objects.create(title='TestChat', create_cover=False)
+        ChatUser.objects.create(chat=self.chat, user=self.user)
+
+    def create_messages(self, count):
+        messages = Message.objects.bulk_create([Message(user=self.user, chat=self.chat) for _ in range(count)])
+        # sqlite does not return ids from bulk inserts
+        messages = list(self.chat.messages.order_by('-id')[:count])
+        File.objects.bulk_create([File(chat=self.chat, message=message, file=f'TestChat/{message.id}.txt')
+                                  for message in messages])
+
+    def assert_page_queries(self):
+        # authentication, membership, messages, files, articles, reading and advancing last_read
+        with self.assertNumQueries(7):
+            response = self.client.get(reverse('chat_messages', kwargs={'chat_id': self.chat.id}))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        return response.json()
+
+    def test_constant_queries(self):
+        self.create_messages(2)
+        self.assertEqual(len(self.assert_page_queries()['results']), 2)
+
+        self.create_messages(13)
+        content = self.assert_page_queries()
+
+        self.assertEqual(len(content['results']), 15)
+        self.assertTrue(all(len(message['files']) == 1 for message in content['results']))
+
+
+class ChatUsersTestCase(TestUserAuthenticationMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.second_user = create_user(SECOND_USER_DATA)
+        self.user.groups.add(Group.objects.get_or_create(name='student')[0])
+        self.second_user.phone_publicity = False
+        self.second_user.save()
+
+        self.chat = Chat.objects.create(title='TestChat', create_cover=False)
+        ChatUser.objects.bulk_create([ChatUser(chat=self.chat, user=user) for user in [self.user, self.second_user]])
+
+    def tearDown(self):
+        super().tearDown()
+        rmtree(os.path.join(settings.MEDIA_ROOT, SECOND_USER_DATA['email']))
+
+    def test_list_users(self):
+        # authentication, members page and the group of the requesting user once for all rows
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('chat_users', kwargs={'chat_id': self.chat.id}))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        users = {user['id']: user for user in response.json()['results']}
+        self.assertEqual(set(users), {self.user.id, self.second_user.id})
+        # students do not see hidden phone numbers of others
+        self.assertIn('phone_number', users[self.user.id])
+        self.assertNotIn('phone_number', users[self.second_user.id])
+
+    def test_search_users(self):
+        response = self.client.get(reverse('chat_users', kwargs={'chat_id': self.chat.id}), {'search': 'B@'})
+
+        self.assertEqual([user['id'] for user in response.json()['results']], [self.second_user.id])
+
+    @patch.object(CursorChatUserPagination, 'page_size', 2)
+    def test_paginate_users(self):
+        # members with equal names are told apart by id
+        users = [User.objects.create(email=f'{i}@a.com', first_name='Ilya', last_name=last_name, create_avatar=False)
+                 for i, last_name in enumerate(['Auramenka'] * 3 + ['Bykau'])]
+        ChatUser.objects.bulk_create([ChatUser(chat=self.chat, user=user) for user in users])
+        url = reverse('chat_users', kwargs={'chat_id': self.chat.id})
+
+        pages, params = [], {}
+        while True:
+            content = self.client.get(url, params).json()
+            pages.append([user['id'] for user in content['results']])
+            if not content['next']:
+                break
+            params = {'cursor': content['next']}
+
+        expected = sorted(User.objects.filter(chatuser__chat=self.chat).values_list('last_name', 'first_name', 'id'))
+        self.assertEqual(pages, [[pk for _, _, pk in expected[i:i + 2]] for i in range(0, len(expected), 2)])
+
+        # previous goes back over the same pages
+        content = self.client.get(url, {'cursor': content['previous']}).json()
+        self.assertEqual([user['id'] for user in content['results']], pages[-2])
+
+        self.assertEqual(self.client.get(url, {'cursor': 'broken'}).status_code, status.HTTP_404_NOT_FOUND)
+
+
+class ChatPresenceTestCase(TestUserAuthenticationMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.second_user = create_user(SECOND_USER_DATA)
+        self.chat = Chat.objects.create(title='TestChat', create_cover=False)
+        ChatUser.objects.bulk_create([ChatUser(chat=self.chat, user=user) for user in [self.user, self.second_user]])
+
+        async_to_sync(get_presence().touch)(self.user.id, 'test-connection')
+
+    def tearDown(self):
+        super().tearDown()
+        rmtree(os.path.join(settings.MEDIA_ROOT, SECOND_USER_DATA['email']))
+        async_to_sync(get_presence().remove)(self.user.id, 'test-connection')
+
+    def test_chat_presence(self):
+        response = self.client.get(reverse('chat_presence', kwargs={'chat_id': self.chat.id}))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(sorted(response.json(), key=lambda item: item['user_id']), [
+            {'user_id': self.user.id, 'online': True},
+            {'user_id': self.second_user.id, 'online': False},
+        ])
+
+
+class ChatUnreadTestCase(TestUserAuthenticationMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.chats = [Chat.objects.create(title=f'TestChat{i}', create_cover=False) for i in range(3)]
+        ChatUser.objects.bulk_create([ChatUser(chat=chat, user=self.user, unread_count=i)
+                                      for i, chat in enumerate(self.chats)])
+
+    def test_unread_counts(self):
+        # the user lookup of the authentication and one query for all counters
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('chat_unread'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(sorted(response.json(), key=lambda item: item['chat_id']),
+                         [{'chat_id': chat.id, 'unread_count': i} for i, chat in enumerate(self.chats)])
@@ -6,6 +6,11 @@ urlpatterns = [
     path('<int:chat_id>/files/', views.ChatFilesViewSet.as_view({'post': 'create'}), name='chat_files/'),
 
     path('<int:chat_id>/users', views.ChatUsersView.as_view(), name='chat_users'),
+    path('<int:chat_id>/presence', views.ChatPresenceView.as_view(), name='chat_presence'),
 
-    path('<int:chat_id>/messages/', views.ChatMessagesView.as_view(), name='chat_messages')
+    path('<int:chat_id>/messages/', views.ChatMessagesView.as_view(), name='chat_messages'),
+
+    path('unread', views.ChatUnreadView.as_view(), name='chat_unread'),
+
+    path('metrics', views.ChatMetricsView.as_view(), name='chat_metrics'),
 ]
@@ -0,0 +1,60 @@
+from contextlib import contextmanager
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from rest_framework_simplejwt.tokens import AccessToken
+from chat.models import Chat, ChatUser
+from chat.routing import websocket_urlpatterns
+from config.middlewares import TokenAuthMiddleware
+from users.models import User
+
+
+IN_MEMORY_CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+    },
+}
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = min(len(values) - 1, round(percent / 100 * (len(values) - 1)))
+    return values[index]
+
+
+@contextmanager
+def benchmark_environment():
+    """
+    runs benchmarks against a throwaway test database and the in-memory channel layer
+    """
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+
+    try:
+        # benchmarks send as fast as they can, rate limits would reject them
+        with override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, CHAT_RATE_LIMITS={}, CHAT_USER_RATE_LIMITS={},
+                               CHAT_OUTBOUND_WINDOW=10 ** 9, CHAT_OUTBOUND_ACK_INTERVAL=10 ** 9):
+            yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+@database_sync_to_async
+def create_benchmark_chat():
+    user = User(email='bench@bench.by', first_name='Bench', last_name='Mark', create_avatar=False)
+    user.save()
+    chat = Chat.objects.create(title='BenchChat', create_cover=False)
+    ChatUser.objects.create(chat=chat, user=user)
+
+    return user, chat
+
+
+async def connect(user):
+    application = TokenAuthMiddleware(URLRouter(websocket_urlpatterns))
+    communicator = WebsocketCommunicator(application, f'/ws/chat/?access={AccessToken.for_user(user)}')
+    await communicator.connect()
+
+    return communicator
@@ -0,0 +1,18 @@
+from collections import Counter
+
+
+# process-wide chat counters, every worker process reports its own values
+counters = Counter()
+
+
+def increment(name, value=1):
+    counters[name] += value
+
+
+def observe_max(name, value):
+    if value > counters[name]:
+        counters[name] = value
+
+
+def snapshot():
+    return dict(counters)
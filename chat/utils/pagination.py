@@ -0,0 +1,100 @@
+import base64
+import json
+from collections import OrderedDict
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+
+
+class KeysetCursorPagination(BasePagination):
+    """
+    Cursor pagination over the whole `ordering` tuple, which must end with a unique field.
+    DRF's CursorPagination keys on the first field only and skips its ties with an offset,
+    here every page is one range query over an index of the ordering fields, whatever the number of ties.
+    Responses keep the {'next', 'previous', 'results'} format of the other paginators
+    """
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+    page_size = None
+    ordering = ()
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.fields = [(field.lstrip('-'), field.startswith('-')) for field in self.ordering]
+        position, reverse = self.decode_cursor(request, queryset)
+
+        # a previous page is read backwards from its position and turned around afterwards
+        ordering = [f'-{name}' if descending != reverse else name for name, descending in self.fields]
+        if position is not None:
+            queryset = queryset.filter(self.get_position_filter(position, reverse))
+
+        results = list(queryset.order_by(*ordering)[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if reverse:
+            results.reverse()
+
+        self.has_next = has_more if not reverse else position is not None
+        self.has_previous = has_more if reverse else position is not None
+        self.page = results
+
+        return results
+
+    def get_position_filter(self, position, reverse):
+        """
+        rows after `position` in the ordering: (a > x) or (a = x and b > y) or ..., descending fields
+        compare with lt. The bound of the first field lets the database scan the index from the position
+        """
+        query = Q()
+        equal = {}
+        for (name, descending), value in zip(self.fields, position):
+            lookup = 'lt' if descending != reverse else 'gt'
+            query |= Q(**equal, **{f'{name}__{lookup}': value})
+            equal[name] = value
+
+        first_name, first_descending = self.fields[0]
+        first_lookup = 'lte' if first_descending != reverse else 'gte'
+
+        return Q(**{f'{first_name}__{first_lookup}': position[0]}) & query
+
+    def encode_cursor(self, instance, reverse):
+        cursor = {'p': [getattr(instance, name) for name, _ in self.fields], 'r': reverse}
+
+        return base64.urlsafe_b64encode(json.dumps(cursor, cls=DjangoJSONEncoder).encode()).decode().rstrip('=')
+
+    def decode_cursor(self, request, queryset):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None, False
+
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4)))
+            position = [self.get_output_field(queryset, name).to_python(value)
+                        for (name, _), value in zip(self.fields, cursor['p'])]
+            reverse = bool(cursor['r'])
+        except (TypeError, ValueError, KeyError):
+            raise NotFound(self.invalid_cursor_message)
+
+        if len(position) != len(self.fields):
+            raise NotFound(self.invalid_cursor_message)
+
+        return position, reverse
+
+    @staticmethod
+    def get_output_field(queryset, name):
+        # annotated values, e.g. last_activity of the chat list, are typed by their expressions
+        if name in queryset.query.annotations:
+            return queryset.query.annotations[name].output_field
+
+        return queryset.model._meta.get_field(name)
+
+    def get_paginated_response(self, data):
+        next_cursor = self.encode_cursor(self.page[-1], False) if self.has_next and self.page else None
+        previous_cursor = self.encode_cursor(self.page[0], True) if self.has_previous and self.page else None
+
+        return Response(OrderedDict([
+            ('next', next_cursor),
+            ('previous', previous_cursor),
+            ('results', data),
+        ]))
@@ -0,0 +1,95 @@
+import asyncio
+import time
+import weakref
+from functools import lru_cache
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+class InMemoryPresence:
+    """
+    Presence of the sockets served by this process, for single node and test setups
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        # {user id: {connection id: expiration time}}
+        self.connections = {}
+
+    async def touch(self, user_id, connection_id):
+        self.connections.setdefault(user_id, {})[connection_id] = time.monotonic() + self.ttl
+
+    async def remove(self, user_id, connection_id):
+        connections = self.connections.get(user_id, {})
+        connections.pop(connection_id, None)
+        if not connections:
+            self.connections.pop(user_id, None)
+
+    async def get_online(self, user_ids):
+        now = time.monotonic()
+
+        return {user_id for user_id in user_ids
+                if any(expires > now for expires in self.connections.get(user_id, {}).values())}
+
+
+class RedisPresence:
+    """
+    Presence shared by all workers. Every user has a sorted set of connection ids scored
+    by expiration time, so a crashed worker's sockets disappear after `ttl` seconds
+    """
+    KEY_PREFIX = 'presence:'
+
+    def __init__(self, ttl, **options):
+        self.ttl = ttl
+        self.options = options
+        # aioredis pools are bound to the event loop they were created in
+        self.pools = weakref.WeakKeyDictionary()
+
+    async def get_pool(self):
+        import aioredis
+
+        loop = asyncio.get_running_loop()
+        if loop not in self.pools:
+            self.pools[loop] = await aioredis.create_redis_pool(**self.options)
+
+        return self.pools[loop]
+
+    def get_key(self, user_id):
+        return f'{self.KEY_PREFIX}{user_id}'
+
+    async def touch(self, user_id, connection_id):
+        pool = await self.get_pool()
+        key = self.get_key(user_id)
+        now = time.time()
+
+        pipe = pool.pipeline()
+        pipe.zremrangebyscore(key, max=now)
+        pipe.zadd(key, now + self.ttl, connection_id)
+        pipe.expire(key, int(self.ttl) + 1)
+        await pipe.execute()
+
+    async def remove(self, user_id, connection_id):
+        pool = await self.get_pool()
+        await pool.zrem(self.get_key(user_id), connection_id)
+
+    async def get_online(self, user_ids):
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+
+        pool = await self.get_pool()
+        now = time.time()
+
+        # one round trip for the whole list of users
+        pipe = pool.pipeline()
+        for user_id in user_ids:
+            pipe.zcount(self.get_key(user_id), min=now)
+        counts = await pipe.execute()
+
+        return {user_id for user_id, count in zip(user_ids, counts) if count}
+
+
+@lru_cache(maxsize=None)
+def get_presence():
+    backend = import_string(settings.CHAT_PRESENCE_BACKEND)
+
+    return backend(settings.CHAT_PRESENCE_TTL, **settings.CHAT_PRESENCE_OPTIONS)
@@ -0,0 +1,29 @@
+import time
+
+
+class TokenBucket:
+    """
+    Allows `rate` actions per second on average and bursts of up to `capacity` actions
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, tokens=1):
+        self.refill()
+        if self.tokens < tokens:
+            return False
+
+        self.tokens -= tokens
+        return True
+
+    def retry_after(self, tokens=1):
+        self.refill()
+        return max(0, (tokens - self.tokens) / self.rate)
@@ -0,0 +1,31 @@
+import asyncio
+
+
+class ReadPositionBuffer:
+    """
+    Coalesces read receipts: only the furthest position of every (chat id, user id) submitted
+    within `delay` seconds is passed to `flush_positions`, as a dict, with one call
+    """
+    def __init__(self, flush_positions, delay):
+        self.flush_positions = flush_positions
+        self.delay = delay
+        self.pending = {}
+        self.flush_task = None
+
+    def submit(self, chat_id, user_id, message_id):
+        key = (chat_id, user_id)
+        if message_id > self.pending.get(key, 0):
+            self.pending[key] = message_id
+
+        if not self.flush_task:
+            self.flush_task = asyncio.ensure_future(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(self.delay)
+        self.flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        positions, self.pending = self.pending, {}
+        if positions:
+            await self.flush_positions(positions)
@@ -0,0 +1,78 @@
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO
+from django.conf import settings
+from django.db import connections
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+
+logger = logging.getLogger(__name__)
+
+executor = None
+# waits for the pool and stores the results, its thread is started on the first submit
+dispatcher = ThreadPoolExecutor(max_workers=1, thread_name_prefix='previews')
+
+
+def render_previews(data, sizes):
+    """
+    downscales an image to fit every size in `sizes` and returns JPEG bytes for each of them,
+    or None if the data is not a readable image. Runs in a worker process, so it must not touch Django
+    """
+    max_size = max(sizes)
+
+    try:
+        image = Image.open(BytesIO(data))
+        # JPEGs are decoded at the smallest scale which still covers the largest size
+        image.draft('RGB', (max_size, max_size))
+        image = ImageOps.exif_transpose(image).convert('RGB')
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError):
+        return None
+
+    # every size is resized from the next larger one instead of the full image
+    previews = {}
+    for size in sorted(sizes, reverse=True):
+        image.thumbnail((size, size))
+
+        output = BytesIO()
+        image.save(output, format='JPEG', quality=80, optimize=True)
+        previews[size] = output.getvalue()
+
+    return [previews[size] for size in sizes]
+
+
+def get_executor():
+    global executor
+
+    if executor is None and settings.CHAT_THUMBNAIL_WORKERS:
+        # spawned workers do not inherit the threads, event loop and sockets of the server process,
+        # which a fork from inside a running ASGI worker would copy
+        executor = ProcessPoolExecutor(max_workers=settings.CHAT_THUMBNAIL_WORKERS,
+                                       mp_context=multiprocessing.get_context('spawn'))
+
+    return executor
+
+
+def store_previews(data, sizes, callback):
+    try:
+        callback(get_executor().submit(render_previews, data, sizes).result())
+    except Exception:
+        logger.exception('Failed to generate image previews')
+    finally:
+        # the thread is not managed by request signals, so its connections are closed here
+        connections.close_all()
+
+
+def generate_previews(data, callback):
+    """
+    renders (thumbnail, preview) JPEG bytes or None and passes them to `callback`. With a pool the rendering
+    and the callback run in the background, so uploads do not wait for them; the returned future is done
+    when the callback has finished. Without a pool both run in the calling thread and None is returned
+    """
+    sizes = [settings.CHAT_THUMBNAIL_SIZE, settings.CHAT_PREVIEW_SIZE]
+
+    if get_executor() is None:
+        callback(render_previews(data, sizes))
+        return None
+
+    return dispatcher.submit(store_previews, data, sizes, callback)
@@ -0,0 +1,54 @@
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Bounded in-process mapping. Entries expire `ttl` seconds after they were set,
+    the oldest ones are evicted first when there are more than `maxsize` of them
+    """
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self.data.get(key)
+        if item is None:
+            return default
+
+        expires, value = item
+        if expires <= time.monotonic():
+            del self.data[key]
+            return default
+
+        return value
+
+    def set(self, key, value):
+        # entries are kept in expiration order, so expired and evicted ones are always at the beginning
+        self.data.pop(key, None)
+        self.data[key] = (time.monotonic() + self.ttl, value)
+        self.evict()
+
+    def pop(self, key, default=None):
+        value = self.get(key, default)
+        self.data.pop(key, None)
+        return value
+
+    def evict(self):
+        now = time.monotonic()
+        while self.data:
+            expires, _ = next(iter(self.data.values()))
+            if expires > now and len(self.data) <= self.maxsize:
+                break
+            self.data.popitem(last=False)
+
+    def clear(self):
+        self.data.clear()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        self.evict()
+        return len(self.data)
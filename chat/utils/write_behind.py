@@ -0,0 +1,62 @@
+import asyncio
+
+
+class WriteBehindBuffer:
+    """
+    Collects items for up to `delay` seconds or until `max_size` items are pending
+    and persists them with one call of `flush_items`, which returns results in the same order.
+    An exception returned as a result fails only the submit of its own item
+    """
+    def __init__(self, flush_items, delay, max_size):
+        self.flush_items = flush_items
+        self.delay = delay
+        self.max_size = max_size
+        self.pending = []
+        self.flush_task = None
+
+    async def submit(self, item):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((item, future))
+
+        if len(self.pending) >= self.max_size:
+            self.flush_now()
+        elif not self.flush_task:
+            self.flush_task = asyncio.ensure_future(self.flush_later())
+
+        return await future
+
+    async def flush_later(self):
+        await asyncio.sleep(self.delay)
+        # flush_now must not cancel a flush which is already running
+        self.flush_task = None
+        await self.flush()
+
+    def flush_now(self):
+        if self.flush_task:
+            self.flush_task.cancel()
+            self.flush_task = None
+
+        asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+
+        try:
+            results = await self.flush_items([item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), result in zip(batch, results):
+            # a consumer may have disconnected while waiting
+            if future.done():
+                continue
+
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
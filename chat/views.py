@@ -1,4 +1,6 @@
 from collections import OrderedDict
+from asgiref.sync import async_to_sync
+from django.db.models import Q
 from rest_framework import viewsets, generics
 from rest_framework.parsers import FormParser, MultiPartParser
 from rest_framework.response import Response
@@ -6,18 +8,17 @@ from rest_framework.pagination import CursorPagination
 from .serializers import FileSerializer, MessageSerializer
 from .models import Message, ChatUser, File, Chat
 from .permissions import IsChatMember
+from .utils import metrics
+from .utils.pagination import KeysetCursorPagination
+from .utils.presence import get_presence
 from rest_framework import status
 from rest_framework.generics import ListAPIView
+from rest_framework.permissions import IsAdminUser
+from rest_framework.views import APIView
+from users.models import User
 from users.serializers import ChatUserSerializer
 
 
-class ChatUsersView(ListAPIView):
-    serializer_class = ChatUserSerializer
-
-    def get_queryset(self):
-        return Chat.objects.filter(pk=self.kwargs['chat_id']).first().users.all()
-
-
 def get_cursor_from_url(url):
     get_params = url.split('?')[1].split('&')
     for param in get_params:
@@ -41,6 +42,28 @@ class CustomCursorPaginator(CursorPagination):
         ]))
 
 
+class CursorChatUserPagination(KeysetCursorPagination):
+    page_size = 50
+    # a keyset over the whole tuple, members with equal names do not degrade to offset scans
+    ordering = ('last_name', 'first_name', 'id')
+
+
+class ChatUsersView(ListAPIView):
+    serializer_class = ChatUserSerializer
+    pagination_class = CursorChatUserPagination
+
+    def get_queryset(self):
+        queryset = User.objects.filter(chatuser__chat_id=self.kwargs['chat_id'])
+
+        # prefix search, served by the upper case indexes of the users table
+        search = self.request.GET.get('search', '').strip()
+        if search:
+            queryset = queryset.filter(Q(first_name__istartswith=search) | Q(last_name__istartswith=search) |
+                                       Q(email__istartswith=search))
+
+        return queryset
+
+
 class CursorFilePagination(CustomCursorPaginator):
     page_size = 36
     ordering = '-id'
@@ -69,7 +92,14 @@ class ChatFilesViewSet(viewsets.ModelViewSet):
                                              'IMG and DOC are available'},
                             status=status.HTTP_400_BAD_REQUEST)
 
-        return super().list(request, *args, **kwargs)
+        response = super().list(request, *args, **kwargs)
+
+        # the first page carries the numbers of files of every type, kept on Chat when files are written
+        if not request.GET.get(self.paginator.cursor_query_param):
+            counts = Chat.objects.filter(pk=kwargs['chat_id']).values(*File.COUNT_FIELDS.values()).first() or {}
+            response.data['counts'] = {key: counts.get(field, 0) for key, field in File.COUNT_FIELDS.items()}
+
+        return response
 
     def create(self, request, *args, **kwargs):
         request.data['chat'] = kwargs['chat_id']
@@ -83,7 +113,8 @@ class ChatFilesViewSet(viewsets.ModelViewSet):
 
 class CursorMessagePagination(CustomCursorPaginator):
     page_size = 15
-    ordering = '-date'
+    # id breaks ties between messages sent at the same moment
+    ordering = ('-date', '-id')
 
 
 class ChatMessagesView(generics.ListAPIView):
@@ -96,20 +127,69 @@ class ChatMessagesView(generics.ListAPIView):
         return super().list(request, *args, **kwargs)
 
     def get_queryset(self):
-        return Message.objects.select_related('user', 'chat') \
-            .prefetch_related('files').filter(chat_id=self.kwargs['chat_id'])
+        queryset = Message.objects.select_related('user') \
+            .prefetch_related('files', 'articles').filter(chat_id=self.kwargs['chat_id'])
 
-    def get_paginated_response(self, data):
-        chat_user = ChatUser.objects.select_related('chat').get(user=self.request.user,
-                                                                chat_id=self.kwargs['chat_id'])
+        # exact range of sequence numbers, used by clients to fetch missed messages
+        seq_from = self.request.GET.get('seq_from', '')
+        if seq_from.isdigit():
+            queryset = queryset.filter(seq__gte=int(seq_from))
+
+        seq_to = self.request.GET.get('seq_to', '')
+        if seq_to.isdigit():
+            queryset = queryset.filter(seq__lte=int(seq_to))
+
+        return queryset
 
+    def get_paginated_response(self, data):
         response = self.paginator.get_paginated_response(data)
 
         if not response.data['results']:
             return response
 
+        last_read = ChatUser.objects.filter(user=self.request.user, chat_id=self.kwargs['chat_id']) \
+            .values_list('last_read', flat=True).first()
         last_message_id = response.data['results'][0]['id']
 
-        response.data['last_read'] = chat_user.change_last_read(last_message_id)
+        # only the first page holds the newest messages, scrolling back through history writes nothing
+        if not self.request.GET.get(self.paginator.cursor_query_param) and \
+                (last_read is None or last_message_id > last_read):
+            ChatUser.advance_last_read(self.kwargs['chat_id'], self.request.user.id, last_message_id)
+            last_read = last_message_id
+
+        response.data['last_read'] = last_read
 
         return response
+
+
+class ChatPresenceView(APIView):
+    """
+    Online status of every chat member, fetched from the presence store in one batch
+    """
+    permission_classes = [IsChatMember]
+
+    def get(self, request, chat_id):
+        member_ids = list(ChatUser.objects.filter(chat_id=chat_id).values_list('user_id', flat=True))
+        online_ids = async_to_sync(get_presence().get_online)(member_ids)
+
+        return Response([{'user_id': user_id, 'online': user_id in online_ids} for user_id in member_ids])
+
+
+class ChatUnreadView(APIView):
+    """
+    Unread counters of all chats of the user, read from ChatUser with one query
+    """
+    def get(self, request):
+        counts = ChatUser.objects.filter(user=request.user).values('chat_id', 'unread_count')
+
+        return Response(list(counts))
+
+
+class ChatMetricsView(APIView):
+    """
+    WebSocket chat counters of the worker process which serves the request
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(metrics.snapshot())
@@ -1,5 +1,6 @@
 from PIL import Image, ImageDraw, ImageFont
 from django.conf import settings
+from django.contrib.staticfiles import finders
 import os
 import requests
 from io import BytesIO
@@ -25,7 +26,8 @@ def get_font():
     if 'production' in os.environ.get('DJANGO_SETTINGS_MODULE'):
         return BytesIO(response.content)
     else:
-        return 'static/fonts/impactregular.ttf'
+        # found in the app's static directory, so collectstatic is not needed in development and tests
+        return finders.find('fonts/impactregular.ttf')
 
 
 def reduce_font_size_by_width(word, font_size):
@@ -24,5 +24,8 @@ class TokenAuthMiddleware(BaseMiddleware):
             return
 
         scope['user'] = await get_user(int(payload['user_id']))
+        # consumers rely on the decoded token instead of verifying it again for every frame
+        scope['token_payload'] = payload
+        scope['token_exp'] = payload['exp']
 
         return await super().__call__(scope, receive, send)
@@ -168,3 +168,75 @@ EMAIL_HOST = 'smtp.gmail.com'
 EMAIL_HOST_USER = os.environ.get('EMAIL_HOST_USER')
 EMAIL_HOST_PASSWORD = os.environ.get('EMAIL_HOST_PASSWORD')
 EMAIL_PORT = 587
+
+# WebSocket chat
+# sockets join only the chats they subscribe to, other chats send unread badges to the user's group
+CHAT_LAZY_SUBSCRIPTIONS = False
+CHAT_MAX_SUBSCRIPTIONS = 100
+# accept the MessagePack subprotocol. Every broadcast then carries a MessagePack copy of its JSON frame
+# through the channel layer, so deployments without such clients should turn it off
+CHAT_MSGPACK = True
+# new messages are buffered for up to CHAT_WRITE_BEHIND_DELAY seconds or CHAT_WRITE_BEHIND_MAX_SIZE messages
+# and inserted in one transaction
+CHAT_WRITE_BEHIND = False
+CHAT_WRITE_BEHIND_DELAY = 0.005
+CHAT_WRITE_BEHIND_MAX_SIZE = 50
+# retried new messages with the same client_side_id in the same chat are answered from this cache without writes,
+# or found in the database. After CHAT_DEDUPE_TTL seconds the id may be reused by a new message
+CHAT_DEDUPE_CACHE_SIZE = 10000
+CHAT_DEDUPE_TTL = 300
+# the sync command returns at most this many missed messages at once
+CHAT_SYNC_MAX_MESSAGES = 500
+# every CHAT_OUTBOUND_ACK_INTERVAL frames sockets get a ping. Clients which answer with a pong echoing its frame
+# opt in to flow control: when CHAT_OUTBOUND_WINDOW frames are unacknowledged they are told to 'resync'
+# or the socket gets 'close'd. Clients which never echo a frame get every broadcast
+CHAT_OUTBOUND_WINDOW = 256
+CHAT_OUTBOUND_ACK_INTERVAL = 32
+CHAT_OUTBOUND_OVERFLOW_POLICY = 'resync'
+# token buckets as (messages per second, burst) for every socket and for all sockets of a user in a worker
+CHAT_RATE_LIMITS = {
+    'new_message': (1, 10),
+    'update_message': (0.5, 5),
+    'delete_message': (0.5, 5),
+    'sync': (0.2, 5),
+    'subscribe': (1, 10),
+    'unsubscribe': (1, 10),
+    'refresh_token': (0.1, 3),
+    'typing': (2, 10),
+    'ping': (1, 5),
+    'read': (2, 10),
+}
+CHAT_USER_RATE_LIMITS = {
+    'new_message': (2, 20),
+    'update_message': (1, 10),
+    'delete_message': (1, 10),
+}
+# buckets of at most CHAT_USER_RATE_LIMIT_CACHE_SIZE (user, message type) pairs are kept per worker,
+# a bucket unused for CHAT_USER_RATE_LIMIT_TTL seconds is dropped and starts full again
+CHAT_USER_RATE_LIMIT_CACHE_SIZE = 10000
+CHAT_USER_RATE_LIMIT_TTL = 600
+# typing events of a user in a chat are broadcast at most once per CHAT_TYPING_WINDOW seconds,
+# clients hide the indicator CHAT_TYPING_TTL seconds after the last one
+CHAT_TYPING_WINDOW = 3
+CHAT_TYPING_TTL = 5
+CHAT_TYPING_CACHE_SIZE = 10000
+# connections refresh their presence every CHAT_PRESENCE_HEARTBEAT seconds and are offline
+# CHAT_PRESENCE_TTL seconds after the last heartbeat. RedisPresence takes aioredis pool options
+CHAT_PRESENCE_BACKEND = 'chat.utils.presence.InMemoryPresence'
+CHAT_PRESENCE_OPTIONS = {}
+CHAT_PRESENCE_HEARTBEAT = 25
+CHAT_PRESENCE_TTL = 60
+# silent sockets get a ping after CHAT_PING_INTERVAL seconds and are closed after CHAT_IDLE_TIMEOUT seconds
+CHAT_PING_INTERVAL = 30
+CHAT_IDLE_TIMEOUT = 75
+# read receipts received over the socket are coalesced and written once per CHAT_READ_FLUSH_DELAY seconds
+CHAT_READ_FLUSH_DELAY = 1
+# saved read positions of at most CHAT_READ_POSITIONS_CACHE_SIZE (chat, user) pairs are remembered per worker
+# for CHAT_READ_POSITIONS_TTL seconds, so receipts which do not move them skip the database
+CHAT_READ_POSITIONS_CACHE_SIZE = 10000
+CHAT_READ_POSITIONS_TTL = 600
+# image attachments get thumbnails and previews fitting these sizes in pixels, rendered after the upload
+# is committed by a pool of CHAT_THUMBNAIL_WORKERS spawned processes, 0 renders them in the serving process
+CHAT_THUMBNAIL_SIZE = 256
+CHAT_PREVIEW_SIZE = 1024
+CHAT_THUMBNAIL_WORKERS = 2
@@ -23,6 +23,9 @@ CHANNEL_LAYERS = {
     },
 }
 
+CHAT_PRESENCE_BACKEND = 'chat.utils.presence.RedisPresence'
+CHAT_PRESENCE_OPTIONS = {'address': os.environ.get('REDIS_URL')}
+
 STATICFILES_STORAGE = 'config.storage_backends.StaticStorage'
 DEFAULT_FILE_STORAGE = 'config.storage_backends.MediaStorage'
 
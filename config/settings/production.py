@@ -19,6 +19,9 @@ CHANNEL_LAYERS = {
     },
 }
 
+CHAT_PRESENCE_BACKEND = 'chat.utils.presence.RedisPresence'
+CHAT_PRESENCE_OPTIONS = heroku_redis_ssl_host
+
 SIMPLE_JWT['AUTH_COOKIE_SECURE'] = True
 
 # MIDDLEWARE.insert(0, 'django.middleware.cache.UpdateCacheMiddleware')
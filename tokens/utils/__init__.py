@@ -1 +1 @@
-from .functions import check_token
+from .functions import check_token, decode_token
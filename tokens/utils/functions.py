@@ -13,10 +13,14 @@ def parse_query_sting(query_string):
     return kwargs['access']
 
 
-def check_token(query_string):
-    token = parse_query_sting(query_string)
-
+def decode_token(token):
     try:
         return jwt.decode(token, settings.SECRET_KEY, algorithms=['HS256'])
     except Exception as e:
         return False
+
+
+def check_token(query_string):
+    token = parse_query_sting(query_string)
+
+    return decode_token(token)
@@ -0,0 +1,36 @@
+# Generated by Django 3.2.9 on 2026-10-18 13:35
+
+from django.db import migrations
+
+
+SEARCH_FIELDS = ['first_name', 'last_name', 'email']
+
+
+def create_search_indexes(apps, schema_editor):
+    # istartswith compiles to UPPER(field) LIKE UPPER('prefix%') on PostgreSQL, which uses such an index
+    # only with a pattern operator class. Django 3.2 cannot declare operator classes for expressions
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    for field in SEARCH_FIELDS:
+        schema_editor.execute(f'CREATE INDEX IF NOT EXISTS users_user_{field}_upper_like '
+                              f'ON users_user (UPPER({field}) text_pattern_ops)')
+
+
+def drop_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    for field in SEARCH_FIELDS:
+        schema_editor.execute(f'DROP INDEX IF EXISTS users_user_{field}_upper_like')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0008_auto_20220324_2108'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
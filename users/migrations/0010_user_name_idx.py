@@ -0,0 +1,17 @@
+# Generated by Django 3.2.9 on 2026-10-18 14:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0009_user_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['last_name', 'first_name', 'id'], name='user_name_idx'),
+        ),
+    ]
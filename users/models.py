@@ -96,6 +96,12 @@ class User(AbstractUser):
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = []
 
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            # keyset pagination of chat members
+            models.Index(fields=['last_name', 'first_name', 'id'], name='user_name_idx'),
+        ]
+
 
 class Student(User):
     group = models.ForeignKey('college.StudentGroup', related_name='students',
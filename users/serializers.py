@@ -51,10 +51,18 @@ class UserSerializer(serializers.ModelSerializer):
 
 
 class ChatUserSerializer(serializers.ModelSerializer):
+    def get_requester_group_name(self):
+        # the context is shared by all rows of a list, so the group is queried once per request
+        if 'requester_group_name' not in self.context:
+            group = self.context['request'].user.groups.first()
+            self.context['requester_group_name'] = group.name if group else None
+
+        return self.context['requester_group_name']
+
     def to_representation(self, instance):
         representation = super().to_representation(instance)
         if self.context['request'].user.id == instance.id or \
-                self.context['request'].user.groups.first().name != 'student' or instance.phone_publicity:
+                self.get_requester_group_name() != 'student' or instance.phone_publicity:
             representation['phone_number'] = instance.phone_number
         return representation
 
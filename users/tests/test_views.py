@@ -1,4 +1,5 @@
 import json
+import os
 from urllib import parse
 from django.urls import reverse
 from rest_framework import status
@@ -45,15 +46,28 @@ class IDSpecifiedUserTestCase(TestUserAuthenticationMixin, APITestCase):
         ChatUser.objects.bulk_create([
             ChatUser(user=self.user, chat=chat) for chat in Chat.objects.all()])
 
+    def get_chat_list(self, params=None):
+        response = self.client.get(reverse('user_chats', kwargs={'user_id': 1}), params)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        content = json.loads(response.content)
+        for chat in content['results']:
+            self.assertIn('last_activity', chat)
+            self.assertIn('version', chat)
+
+        return content
+
     def test_get_chat_list(self):
         self.create_chats()
 
-        response = self.client.get(reverse('user_chats', kwargs={'user_id': 1}))
+        content = self.get_chat_list()
 
-        self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(json.loads(response.content), [
-            {'id': 1, 'title': 'something1', 'cover': None, 'last_message': None},
-            {'id': 2, 'title': 'something2', 'cover': None, 'last_message': None}])
+        # the chat with the latest activity comes first
+        self.assertEqual([{key: chat[key] for key in ['id', 'title', 'cover', 'message_count', 'last_message']}
+                          for chat in content['results']], [
+            {'id': 2, 'title': 'something2', 'cover': None, 'message_count': 0, 'last_message': None},
+            {'id': 1, 'title': 'something1', 'cover': None, 'message_count': 0, 'last_message': None}])
 
     def test_get_chat_list_with_last_message(self):
         self.create_chats()
@@ -61,16 +75,61 @@ class IDSpecifiedUserTestCase(TestUserAuthenticationMixin, APITestCase):
             [Message(user=self.user, chat=chat, text='something') for chat in Chat.objects.all()]
         )
 
-        response = self.client.get(reverse('user_chats', kwargs={'user_id': 1}))
+        content = self.get_chat_list()
 
-        self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(json.loads(response.content), [
-            {'id': message.chat.id, 'title': message.chat.title, 'cover': None,
+        self.assertEqual([{key: chat[key] for key in ['id', 'title', 'cover', 'message_count', 'last_message']}
+                          for chat in content['results']], [
+            {'id': message.chat.id, 'title': message.chat.title, 'cover': None, 'message_count': 1,
              'last_message':
                  {'id': message.id, 'text': 'something',
                   'date': f'{message.date.isoformat().split("+")[0]}Z',
-                  'user': {'avatar': None}}
-             } for message in Message.objects.all()])
+                  'user': {'avatar': self.user.avatar.url}}
+             } for message in Message.objects.order_by('-id')])
+
+    def test_get_chat_list_queries(self):
+        self.create_chats()
+        Message.objects.bulk_create(
+            [Message(user=self.user, chat=chat, text='something') for chat in Chat.objects.all()]
+        )
+
+        # authentication and one joined query for the chats with their last messages
+        with self.assertNumQueries(2):
+            content = self.get_chat_list()
+
+        self.assertEqual([chat['last_message']['text'] for chat in content['results']], ['something', 'something'])
+
+    def test_get_chat_list_changed_since(self):
+        self.create_chats()
+        version = max(chat['version'] for chat in self.get_chat_list()['results'])
+
+        chat = Chat.objects.get(title='something1')
+        # versions are assigned once the transaction commits
+        with self.captureOnCommitCallbacks(execute=True):
+            Message.objects.create(user=self.user, chat=chat, text='something')
+
+        content = self.get_chat_list({'changed_since': version})
+
+        self.assertEqual([chat['id'] for chat in content['results']], [chat.id])
+        self.assertEqual(content['removed'], [])
+        self.assertIsNone(content['next'])
+
+    def test_get_chat_list_membership_changes(self):
+        self.create_chats()
+        with self.captureOnCommitCallbacks(execute=True):
+            joined_chat = Chat.objects.create(title='something3', create_cover=False)
+        version = max(chat['version'] for chat in self.get_chat_list()['results'])
+
+        left_chat = Chat.objects.get(title='something1')
+        with self.captureOnCommitCallbacks(execute=True):
+            ChatUser.objects.create(chat=joined_chat, user=self.user)
+            ChatUser.objects.filter(chat=left_chat, user=self.user).delete()
+
+        content = self.get_chat_list({'changed_since': version})
+
+        # a joined chat is a changed one, a left chat is reported as removed
+        self.assertEqual([chat['id'] for chat in content['results']], [joined_chat.id])
+        self.assertEqual([chat['id'] for chat in content['removed']], [left_chat.id])
+        self.assertGreater(content['removed'][0]['version'], version)
 
 
 class IDSpecifiedOtherUserTestCase(TestSecondUserAuthenticationMixin, APITestCase):
@@ -88,8 +147,8 @@ class IDSpecifiedOtherUserTestCase(TestSecondUserAuthenticationMixin, APITestCas
 
 
 class MeActionsTestCase(TestUserAuthenticationMixin, APITestCase):
-    test_file_path = settings.STATIC_ROOT + 'testpic/2Rt1hFEiPzQ.jpg'
-    filename = test_file_path.split("/")[-1]
+    test_file_path = os.path.join(settings.BASE_DIR, 'college', 'static', 'testpic', '2Rt1hFEiPzQ.jpg')
+    filename = os.path.basename(test_file_path)
 
     def test_me_retrieve(self):
         response = self.client.get(reverse('me'))
@@ -8,7 +8,8 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 from .models import User, EmailVerification
 from chat.serializers import ChatSerializer
-from chat.models import Chat
+from chat.models import Chat, RemovedChat
+from chat.views import CustomCursorPaginator
 from . import serializers
 from .permissions import IsOwner
 from django.utils.crypto import get_random_string
@@ -16,6 +17,7 @@ from django.core.mail import send_mail
 from django.utils.translation import gettext_lazy as _
 from django.core.validators import validate_email
 from django.core.exceptions import ValidationError
+from django.db.models import F
 
 
 class UserRetrieveView(RetrieveAPIView):
@@ -24,12 +26,45 @@ class UserRetrieveView(RetrieveAPIView):
     serializer_class = serializers.UserSerializer
 
 
+class CursorChatPagination(CustomCursorPaginator):
+    page_size = 20
+    # keyset over the (user, last_activity, chat) index of ChatUser
+    ordering = ('-last_activity', '-id')
+
+
 class UserChatsView(ListAPIView):
     permission_classes = [IsOwner]
     serializer_class = ChatSerializer
+    pagination_class = CursorChatPagination
 
     def get_queryset(self):
-        return Chat.objects.filter(chatuser__user=self.request.user)
+        # the chat summary is joined, so a page takes one query whatever the number of chats
+        queryset = Chat.objects.filter(chatuser__user=self.request.user) \
+            .annotate(last_activity=F('chatuser__last_activity')).select_related('last_message__user')
+
+        # only chats changed after the largest version the client has already seen
+        changed_since = self.get_changed_since()
+        if changed_since is not None:
+            queryset = queryset.filter(version__gt=changed_since)
+
+        return queryset
+
+    def get_changed_since(self):
+        changed_since = self.request.GET.get('changed_since', '')
+
+        return int(changed_since) if changed_since.isdigit() else None
+
+    def list(self, request, *args, **kwargs):
+        response = super().list(request, *args, **kwargs)
+
+        # chats the user left or which were deleted, sent with the first page of a delta
+        changed_since = self.get_changed_since()
+        if changed_since is not None and not request.GET.get(self.paginator.cursor_query_param):
+            removed_chats = RemovedChat.objects.filter(user=request.user, version__gt=changed_since) \
+                .order_by('version').values_list('chat_id', 'version')
+            response.data['removed'] = [{'id': chat_id, 'version': version} for chat_id, version in removed_chats]
+
+        return response
 
 
 class UserSelfView(viewsets.ModelViewSet):